@@ -1,11 +1,13 @@
 import asyncio
+import json
 import os
+import typing
 
 import fastapi
 import fastapi.middleware.cors as cors
 import fastapi.middleware.trustedhost as trustedhost
+import httpx
 import opentelemetry.trace as otel_trace
-import requests.exceptions
 import sentry_sdk
 import slowapi
 import slowapi.errors
@@ -94,10 +96,10 @@ class ErrorHandlingMiddleware(middleware.BaseHTTPMiddleware):
             try:
                 return await asyncio.wait_for(call_next(request), timeout=self.timeout)
 
-            except requests.exceptions.HTTPError as exc:
+            except httpx.HTTPStatusError as exc:
                 try:
                     message = exc.response.json()
-                except requests.exceptions.JSONDecodeError:
+                except json.JSONDecodeError:
                     message = exc.response.text
                 logger.exception("HTTP error", exc=exc)
                 return starlette.responses.JSONResponse(
@@ -124,8 +126,8 @@ class ErrorHandlingMiddleware(middleware.BaseHTTPMiddleware):
                 )
 
 
-def init() -> tuple[fastapi.FastAPI, slowapi.Limiter]:
-    app = fastapi.FastAPI()
+def init(lifespan: typing.Any = None) -> tuple[fastapi.FastAPI, slowapi.Limiter]:
+    app = fastapi.FastAPI(lifespan=lifespan)
 
     ####################
     # START MIDDLEWARE #
@@ -0,0 +1,388 @@
+"""Micro-benchmarks for the hot paths, run through `backend.cli bench-*`.
+
+Payloads are synthetic but shaped like real XRPC responses, so sizes and
+nesting depth are representative of what the cache and graph code handle.
+"""
+
+import asyncio
+import contextlib
+import functools
+import http.server
+import json
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import types
+import typing
+import urllib.parse
+
+import numpy
+
+from backend import bsky, cache, data_science, graph, xrpc
+
+
+def _profile(index: int) -> dict[str, typing.Any]:
+    return {
+        "did": f"did:plc:{index:024x}",
+        "handle": f"user-{index}.bsky.social",
+        "displayName": f"User Number {index}",
+        "description": "posting about cats, coffee, and distributed systems " * 2,
+        "avatar": f"https://cdn.bsky.app/img/avatar/plain/did:plc:{index:024x}/bafkrei{index:040x}@jpeg",
+        "associated": {"chat": {"allowIncoming": "following"}},
+        "labels": [],
+        "createdAt": "2024-11-18T19:31:22.491Z",
+        "indexedAt": "2024-11-18T19:31:22.491Z",
+        "viewer": {
+            "muted": False,
+            "blockedBy": False,
+            "following": f"at://did:plc:{index:024x}/app.bsky.graph.follow/3lbfx{index:08x}",
+        },
+    }
+
+
+def follows_payload(count: int = 100) -> dict[str, typing.Any]:
+    """A single `app.bsky.graph.getFollows` page."""
+    return {
+        "subject": _profile(0),
+        "follows": [_profile(index) for index in range(1, count + 1)],
+        "cursor": "3lbfxabcdefgh",
+    }
+
+
+def author_feed_payload(count: int = 100) -> dict[str, typing.Any]:
+    """A single `app.bsky.feed.getAuthorFeed` page."""
+    author = _profile(0)
+    return {
+        "feed": [
+            {
+                "post": {
+                    "uri": f"at://{author['did']}/app.bsky.feed.post/3lc{index:010x}",
+                    "cid": f"bafyrei{index:052x}",
+                    "author": author,
+                    "record": {
+                        "$type": "app.bsky.feed.post",
+                        "createdAt": "2025-01-02T03:04:05.678Z",
+                        "langs": ["en"],
+                        "text": f"post {index}: the cat knocked my coffee onto the keyboard again",
+                    },
+                    "replyCount": index % 7,
+                    "repostCount": index % 5,
+                    "likeCount": index % 31,
+                    "quoteCount": 0,
+                    "indexedAt": "2025-01-02T03:04:05.678Z",
+                    "labels": [],
+                }
+            }
+            for index in range(count)
+        ],
+        "cursor": "2025-01-02T03:04:05.678Z",
+    }
+
+
+def _time_per_call(func: typing.Callable[[], typing.Any], iterations: int) -> float:
+    """Average wall time of `func`, in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def cache_hits(iterations: int = 2000) -> dict[str, dict[str, float]]:
+    """
+    Compare cache hit latency for JSON strings (decoded on every hit)
+    against frozen objects (returned as-is).
+    """
+    results = {}
+    payloads = {
+        "getFollows": follows_payload(),
+        "getAuthorFeed": author_feed_payload(),
+    }
+    for name, payload in payloads.items():
+        encoded = json.dumps(payload)
+        json_store = {name: encoded}
+
+        store = cache.MemoryStore(max_bytes=2**30, max_entries=10, sweep_interval=3600)
+        frozen, size = cache.freeze(payload)
+        store.set(name, frozen, 3600, size)
+
+        results[name] = {
+            "json_hit_us": _time_per_call(
+                functools.partial(json.loads, json_store[name]), iterations
+            ),
+            "frozen_hit_us": _time_per_call(functools.partial(store.get, name), iterations),
+            "json_bytes": len(encoded),
+            "frozen_bytes": size,
+        }
+    return results
+
+
+def _synthetic_follow_lists(sources: int, edges: int, universe: int) -> dict[str, list[str]]:
+    """
+    `sources` accounts each following `edges` handles drawn from a shared pool
+    of `universe` handles. Every handle is its own string object, the way
+    they come out of decoding separate JSON responses.
+    """
+    rng = numpy.random.default_rng(0)
+    return {
+        f"source-{source}.bsky.social": [
+            f"user-{int(i)}.bsky.social" for i in rng.choice(universe, size=edges, replace=False)
+        ]
+        for source in range(sources)
+    }
+
+
+def graph_memory(sources: int = 50, edges: int = 5000, universe: int = 50000) -> dict:
+    """
+    Memory and aggregation time for a follow graph of `sources` x `edges`,
+    held as lists of handle strings versus an interned GraphStore.
+    """
+    results: dict[str, dict[str, float]] = {}
+
+    tracemalloc.start()
+    follow_lists = _synthetic_follow_lists(sources, edges, universe)
+    lists_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    def _count_with_dict() -> dict[str, int]:
+        counts: dict[str, int] = {}
+        for following in follow_lists.values():
+            for handle in following:
+                counts[handle] = counts.get(handle, 0) + 1
+        return counts
+
+    results["lists"] = {
+        "bytes": lists_bytes,
+        "aggregate_ms": _time_per_call(_count_with_dict, 5) / 1000,
+    }
+
+    tracemalloc.start()
+    store = graph.GraphStore()
+    for source, following in follow_lists.items():
+        store.add_following(source, following)
+    # The store only holds on to one copy of each handle.
+    store_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results["graph_store"] = {
+        "bytes": store_bytes,
+        "adjacency_bytes": store.nbytes(),
+        "aggregate_ms": _time_per_call(store.follower_counts, 5) / 1000,
+    }
+    return results
+
+
+# Keywords shaped like typical extract_keywords output, used as the fixture
+# for checking vectorized emoji matching against pairwise Doc.similarity.
+EMOJI_FIXTURE_KEYWORDS = [
+    "cat",
+    "coffee",
+    "keyboard",
+    "rain",
+    "music",
+    "pizza",
+    "happy face",
+    "grinning face",
+    "dog food",
+    "distributed systems",
+    "heart",
+    "fire",
+    "moon",
+    "birthday cake",
+    "kubernetes",
+]
+
+
+def emoji_matching(
+    keywords: list[str] | None = None, num_alternatives: int = 3
+) -> dict[str, typing.Any]:
+    """
+    Time emoji matching for `keywords`, the original per-pair Doc.similarity loop
+    versus the vectorized matrix path, and check both give the same matches in
+    the same order, and the same `num_alternatives` best emojis per keyword.
+    Loads the real spaCy model, so this takes a while to start.
+    """
+    keywords = keywords or EMOJI_FIXTURE_KEYWORDS
+    client = data_science.DataScienceClient()
+    asyncio.run(client.initialize())
+    keyword_data = [data_science.KeywordData(numpy.float64(0), keyword) for keyword in keywords]
+    descriptions = list(client.nlp.pipe(emoji.description for emoji in client.emojis))
+
+    def _pairwise() -> tuple[list[tuple[str, str]], list[list[str]]]:
+        # The loop get_emoji_match_scores replaced, exact-match rules included
+        best: list[tuple[float, str, str]] = []
+        alternatives: list[list[str]] = []
+        for keyword in keywords:
+            keyword_doc = client.nlp(keyword)
+            keyword_scores: list[tuple[float, str]] = []
+            for emoji, description in zip(client.emojis, descriptions, strict=True):
+                if any(
+                    word == emoji.description.lower() for word in keyword.lower().split()
+                ) or any(word == keyword.lower() for word in emoji.description.lower().split()):
+                    score = 1.0
+                else:
+                    score = keyword_doc.similarity(description)
+                keyword_scores.append((score, emoji.emoji))
+            keyword_scores.sort(key=lambda x: -x[0])
+            best.append((keyword_scores[0][0], keyword, keyword_scores[0][1]))
+            alternatives.append([emoji for _, emoji in keyword_scores[:num_alternatives]])
+        best.sort(key=lambda x: -x[0])
+        return [(keyword, emoji) for _, keyword, emoji in best], alternatives
+
+    def _vectorized() -> tuple[list[tuple[str, str]], list[list[str]]]:
+        matches = data_science.get_emoji_match_scores(
+            client, "bench", list(keyword_data), len(keyword_data)
+        )
+        alternatives = data_science.get_emoji_alternatives(client, keywords, num_alternatives)
+        return (
+            [(match.keyword, match.emoji) for match in matches],
+            [[match.emoji for match in row] for row in alternatives],
+        )
+
+    pairwise_start = time.perf_counter()
+    pairwise = _pairwise()
+    pairwise_ms = (time.perf_counter() - pairwise_start) * 1000
+
+    # Cold embeds every keyword, warm finds them all in the keyword vector cache
+    client.keyword_vector_cache.clear()
+    cold_start = time.perf_counter()
+    _vectorized()
+    cold_ms = (time.perf_counter() - cold_start) * 1000
+
+    vectorized = _vectorized()
+    return {
+        "keywords": len(keywords),
+        "pairwise_ms": pairwise_ms,
+        "vectorized_cold_ms": cold_ms,
+        "vectorized_ms": _time_per_call(_vectorized, 5) / 1000,
+        "same_matches": pairwise[0] == vectorized[0],
+        "same_alternatives": pairwise[1] == vectorized[1],
+    }
+
+
+# Run in a fresh interpreter per mode, so RSS isn't shared between loads.
+_NLP_STARTUP_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+from backend import data_science
+nlp = data_science.load_nlp(sys.argv[1], sys.argv[2])
+nlp("warm up").vector
+print(json.dumps({
+    "load_s": time.perf_counter() - start,
+    "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "components": nlp.pipe_names,
+}))
+"""
+
+
+def nlp_startup(model: str | None = None, pipelines: list[str] | None = None) -> dict:
+    """
+    Cold-start time and peak RSS of loading the spaCy model in each of the
+    SPACY_PIPELINE modes, each measured in its own subprocess.
+    """
+    model = model or data_science.SPACY_MODEL
+    results: dict[str, typing.Any] = {"model": model}
+    for pipeline in pipelines or ["full", "trimmed", "vectors"]:
+        output = subprocess.run(
+            [sys.executable, "-c", _NLP_STARTUP_SCRIPT, model, pipeline],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[pipeline] = json.loads(output.strip().splitlines()[-1])
+    return results
+
+
+class _MockFeedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves app.bsky.feed.getAuthorFeed, `author_feed_payload` pages chained
+    by integer cursors, after `server.latency` seconds.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "_MockXrpcServer"
+
+    def do_GET(self) -> None:
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        page = int(query.get("cursor") or 0)
+        time.sleep(self.server.latency)
+        payload = author_feed_payload()
+        payload["cursor"] = str(page + 1) if page + 1 < self.server.pages else ""
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+
+class _MockXrpcServer(http.server.ThreadingHTTPServer):
+    latency: float
+    pages: int
+
+
+@contextlib.contextmanager
+def _mock_xrpc(pages: int, latency: float) -> typing.Iterator[None]:
+    """Point the XRPC client at a local mock server for the duration."""
+    server = _MockXrpcServer(("127.0.0.1", 0), _MockFeedHandler)
+    server.latency = latency
+    server.pages = pages
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = xrpc.XRPC_BASE
+    xrpc.XRPC_BASE = f"http://127.0.0.1:{server.server_port}/xrpc"
+    try:
+        yield
+    finally:
+        xrpc.XRPC_BASE = base
+        server.shutdown()
+        server.server_close()
+
+
+def feed_pipeline(pages: int = 25, latency_ms: float = 50, processing_ms: float = 50) -> dict:
+    """
+    End-to-end time to read `pages` author feed pages from a local mock XRPC
+    server and run a per-page processing stage (a thread sleeping
+    `processing_ms`, standing in for tokenizing the page in the NLP pool).
+    Sequential fetches every page, then processes them. Pipelined processes
+    each page as `bsky.iter_author_feed_posts` yields it, while the next one
+    downloads. Each run uses a fresh handle, so nothing is served from cache.
+    """
+    client = types.SimpleNamespace(_session=types.SimpleNamespace(access_jwt="bench"))
+    processing = processing_ms / 1000
+
+    async def _sequential(handle: str) -> int:
+        fetched = []
+        cursor = ""
+        for _ in range(pages):
+            posts, cursor = await bsky.get_author_feed_posts(client, handle, cursor)
+            fetched.append(posts)
+            if not cursor:
+                break
+        for _ in fetched:
+            await asyncio.to_thread(time.sleep, processing)
+        return len(fetched)
+
+    async def _pipelined(handle: str) -> int:
+        stages = [
+            asyncio.ensure_future(asyncio.to_thread(time.sleep, processing))
+            async for _ in bsky.iter_author_feed_posts(client, handle, pages)
+        ]
+        await asyncio.gather(*stages)
+        return len(stages)
+
+    async def _run() -> dict[str, float | int]:
+        results: dict[str, float | int] = {}
+        for name, variant in (("sequential", _sequential), ("pipelined", _pipelined)):
+            start = time.perf_counter()
+            results[f"{name}_pages"] = await variant(f"bench-{name}-{time.time_ns()}")
+            results[f"{name}_ms"] = (time.perf_counter() - start) * 1000
+        await xrpc.XrpcClient().aclose()
+        return results
+
+    with _mock_xrpc(pages, latency_ms / 1000):
+        results = asyncio.run(_run())
+    return {"pages": pages, "latency_ms": latency_ms, "processing_ms": processing_ms, **results}
@@ -1,13 +1,20 @@
+import asyncio
+import base64
+import bisect
+import dataclasses
+import functools
 import os
 import re
 import time
 import typing
+import weakref
 
 import atproto  # type: ignore
-import requests
+import httpx
+import numpy
 import structlog
 
-from . import cache
+from . import cache, graph, xrpc
 from . import telemetry as _telemetry
 
 telemetry = _telemetry.Telemetry()
@@ -17,10 +24,31 @@ logger = structlog.get_logger()
 MAX_FOLLOWS_PAGES = 25
 
 SUGGESTIONS_PER_PAGE = 10
-MAX_SUGGESTION_PAGES = 10
+# How many of my follows the suggestions are aggregated over
+SUGGESTIONS_SOURCES = 100
+SUGGESTIONS_PREFIX = "bsky.suggestions"
 
 POPULARITY_PER_PAGE = 50
 MAX_POPULARITY_PAGES = 50
+# The materialized view ranks as many accounts as every page of the live
+# aggregation put together.
+POPULARITY_VIEW_SIZE = POPULARITY_PER_PAGE * MAX_POPULARITY_PAGES
+POPULARITY_VIEW_PREFIX = "bsky.popularity-view"
+POPULARITY_GRAPH_PREFIX = "bsky.popularity-graph"
+POPULARITY_TAG = "popularity"
+# Building a view runs as a background job, so it gets longer than a request.
+POPULARITY_BUILD_DEADLINE = float(os.getenv("BSKY_POPULARITY_BUILD_DEADLINE", "300"))
+# How many of my follows a build aggregates over. Anyone can trigger a build
+# for any handle, and each source costs up to MAX_FOLLOWS_PAGES requests on the
+# service's one Bluesky account, so this is kept well under POPULARITY_VIEW_SIZE.
+POPULARITY_BUILD_SOURCES = int(os.getenv("BSKY_POPULARITY_BUILD_SOURCES", "500"))
+
+# How many follow lists the popularity / suggestions fan-out fetches at once.
+FANOUT_CONCURRENCY = int(os.getenv("BSKY_FANOUT_CONCURRENCY", "8"))
+
+# Seconds after which the fan-out stops waiting and returns what it has,
+# comfortably inside ErrorHandlingMiddleware's 30 second timeout.
+FANOUT_DEADLINE = float(os.getenv("BSKY_FANOUT_DEADLINE", "20"))
 
 
 class Bsky:
@@ -56,89 +84,285 @@ def init():
     return client
 
 
-async def popularity(client: atproto.Client, me: str, index=0) -> tuple[dict[str, int], int]:
+async def _fan_out_following_handles(
+    client: atproto.Client, handles: list[str], timeout: float
+) -> typing.AsyncIterator[tuple[str, list[str]]]:
+    """
+    Fetch who each of `handles` follows, at most FANOUT_CONCURRENCY at a time,
+    yielding (handle, following) pairs as soon as they arrive (not in input order).
+    Accounts whose lists can't be fetched are skipped.
+    Raises TimeoutError once `timeout` runs out, unfinished fetches are cancelled.
+    """
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def _fetch(handle: str) -> tuple[str, list[str]]:
+        async with semaphore:
+            return (handle, await get_following_handles(client, handle))
+
+    tasks = [asyncio.create_task(_fetch(handle)) for handle in handles]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=timeout):
+            try:
+                yield await next_done
+            except httpx.HTTPError as exc:
+                logger.info("fan-out", adjective="skip", exc=str(exc))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _prefetch_graph_pages(relation: "GraphRelation", handles: list[str]) -> None:
+    """
+    Pull the cached pages of `relation` for all of `handles` into memory,
+    one bulk cache read per cursor depth rather than one per page,
+    so the fan-out that follows mostly hits the memory tier.
+    """
+    cursors = dict.fromkeys(handles, "")
+    for _ in range(MAX_FOLLOWS_PAGES):
+        if not cursors:
+            break
+        keys = {
+            handle: f"{relation.prefix}-{cursor}-{handle}" for handle, cursor in cursors.items()
+        }
+        pages = await cache.prefetch(list(keys.values()))
+        cursors = {
+            handle: pages[key]["cursor"]
+            for handle, key in keys.items()
+            if key in pages and pages[key].get("cursor")
+        }
+
+
+async def _forget_graph_pages(relation: "GraphRelation", handle: str) -> None:
+    """Drop the cached pages of `relation` for `handle`, so the next read fetches them."""
+    cursor = ""
+    for _ in range(MAX_FOLLOWS_PAGES):
+        page = await cache.get_data(f"{relation.prefix}-{cursor}", handle)
+        await cache.delete_data(f"{relation.prefix}-{cursor}", handle)
+        cursor = page.get("cursor", "") if page is not None else ""
+        if not cursor:
+            break
+
+
+async def _following_graph(
+    client: atproto.Client, me: str, handles: list[str], deadline: float
+) -> tuple[graph.GraphStore, bool]:
+    """
+    Load who each of `handles` follows into a GraphStore.
+    The second value is True if the deadline cut the fan-out short.
+    """
+    store = graph.GraphStore()
+    await _prefetch_graph_pages(FOLLOWING, handles)
+    timeout = deadline - asyncio.get_running_loop().time()
+    try:
+        async for handle, following in _fan_out_following_handles(client, handles, timeout):
+            store.add_following(handle, following)
+    except TimeoutError:
+        logger.info("fan-out", adjective="partial", handle=me)
+        return (store, True)
+    return (store, False)
+
+
+async def popularity(client: atproto.Client, me: str, index=0) -> tuple[dict[str, int], int, bool]:
     """
     For every person I follow,
     list people who they follow,
     and aggregate that list to see how popular each person is.
+    The third value is True if the deadline cut the aggregation short.
     """
+    deadline = asyncio.get_running_loop().time() + FANOUT_DEADLINE
     next_index = index + POPULARITY_PER_PAGE
     my_following = await get_following_handles(client, me)
     my_following.sort()
     my_following_to_check = my_following[index:next_index]
 
-    popularity_dict: dict[str, int] = {}
-
-    # For everyone that I follow,
-    for my_follow in my_following_to_check:
-        # List of who they follow
-        following = await get_following_handles(client, my_follow)
-
-        # And remove the people I follow
-        for thier_follow in following:
-            thier_follow.strip().lower()
-            if thier_follow and thier_follow != "handle.invalid" and thier_follow != "bsky.app":
-                if popularity_dict.get(thier_follow) is None:
-                    popularity_dict[thier_follow] = 1
-                else:
-                    popularity_dict[thier_follow] += 1
+    # For everyone that I follow, count who they follow
+    store, partial = await _following_graph(client, me, my_following_to_check, deadline)
+    counts = store.follower_counts()
+    store.exclude(counts, graph.IGNORED_HANDLES)
+    popularity_dict = store.counts_to_dict(counts)
 
     # return -1 next index (indicating the we are done) if we are at the end of the list
     next_index = next_index if next_index < POPULARITY_PER_PAGE * MAX_POPULARITY_PAGES else -1
 
-    return (popularity_dict, next_index)
+    return (popularity_dict, next_index, partial)
+
+
+# Builds and updates of a handle's view read-modify-write the same entries.
+# Weak values, so a handle's lock goes once nothing holds or waits on it.
+_popularity_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
 
 
-async def suggestions(client: atproto.Client, me: str, index=0) -> tuple[list[str], int]:
+def _popularity_lock(me: str) -> asyncio.Lock:
+    lock = _popularity_locks.get(me)
+    if lock is None:
+        lock = _popularity_locks[me] = asyncio.Lock()
+    return lock
+
+
+async def _save_popularity_view(
+    me: str, store: graph.GraphStore, counts: numpy.ndarray, partial: bool
+) -> dict[str, typing.Any]:
     """
-    For everyone that I follow,
-    list who they follow that I don't follow.
+    Persist the graph behind my popularity view, for incremental updates,
+    and the view itself: the top POPULARITY_VIEW_SIZE accounts, pre-sorted,
+    kept apart so serving a page doesn't decode the whole graph.
+    """
+    ranked_counts = counts.copy()
+    store.exclude(ranked_counts, graph.IGNORED_HANDLES)
+    ranked = store.ranked(ranked_counts, limit=POPULARITY_VIEW_SIZE)
+    state = store.to_state()
+    state["counts"] = base64.b64encode(counts.astype(numpy.uint32).tobytes()).decode()
+    await cache.set_data(POPULARITY_GRAPH_PREFIX, me, state, tags=(POPULARITY_TAG,))
+    summary = {"sources": len(state["following"]), "ranked": len(ranked), "partial": partial}
+    await cache.set_data(
+        POPULARITY_VIEW_PREFIX,
+        me,
+        {**summary, "ranking": ranked, "updated_at": time.time()},
+        tags=(POPULARITY_TAG,),
+    )
+    logger.info("popularity-view", adjective="saved", handle=me, **summary)
+    return summary
+
+
+async def _build_popularity_view(client: atproto.Client, me: str) -> dict[str, typing.Any]:
+    deadline = asyncio.get_running_loop().time() + POPULARITY_BUILD_DEADLINE
+    my_following = await get_following_handles(client, me)
+    my_following.sort()
+    store, partial = await _following_graph(
+        client, me, my_following[:POPULARITY_BUILD_SOURCES], deadline
+    )
+    return await _save_popularity_view(me, store, store.follower_counts(), partial)
+
+
+async def build_popularity_view(client: atproto.Client, me: str) -> dict[str, typing.Any]:
+    """
+    Aggregate the follow lists of the people I follow (up to POPULARITY_BUILD_SOURCES)
+    into my materialized popularity view, see `popularity_view_page`.
+    Meant for a background job, it fans out over every follow at once.
+    """
+    async with _popularity_lock(me):
+        return await _build_popularity_view(client, me)
+
+
+async def update_popularity_view(
+    client: atproto.Client, me: str, source: str
+) -> dict[str, typing.Any]:
+    """
+    Refresh my popularity view after `source`, someone I follow, changed who
+    they follow: their follow list is fetched again, bypassing the cache, and
+    only the difference from the list the view was built with is applied.
+    Builds the whole view if there isn't one yet.
+    """
+    async with _popularity_lock(me):
+        state = await cache.get_data(POPULARITY_GRAPH_PREFIX, me)
+        if state is None:
+            return await _build_popularity_view(client, me)
+        store = graph.GraphStore.from_state(state)
+        if not store.has_following(source):
+            logger.info("popularity-view", adjective="not-a-source", handle=me, source=source)
+            return {"sources": len(state["following"]), "updated": False}
+        counts = numpy.frombuffer(base64.b64decode(state["counts"]), dtype=numpy.uint32)
+
+        await _forget_graph_pages(FOLLOWING, source)
+        following = await get_following_handles(client, source)
+        counts = store.replace_following(counts.astype(numpy.int64), source, following)
+
+        view = await cache.get_data(POPULARITY_VIEW_PREFIX, me)
+        partial = view["partial"] if view is not None else False
+        return await _save_popularity_view(me, store, counts, partial)
+
+
+async def popularity_view_page(me: str, index=0) -> tuple[dict[str, int], int, bool] | None:
+    """
+    The {index} page of my materialized popularity view, most popular first,
+    in the same shape as `popularity`. Pages are slices of the stored ranking,
+    and the next index is -1 on the last one.
+    None if the view hasn't been built (or has expired).
     """
-    next_index = index + SUGGESTIONS_PER_PAGE
+    view = await cache.get_data(POPULARITY_VIEW_PREFIX, me)
+    if view is None:
+        return None
+    ranking = view["ranking"]
+    next_index = index + POPULARITY_PER_PAGE
+    page = {handle: count for handle, count in ranking[index:next_index]}
+    return (page, next_index if next_index < len(ranking) else -1, view["partial"])
+
+
+async def _ranked_suggestions(
+    client: atproto.Client, me: str
+) -> tuple[tuple[tuple[str, int], ...], bool]:
+    """
+    Everyone followed by the first SUGGESTIONS_SOURCES people I follow,
+    that I don't already follow, as (handle, score) pairs ranked by score.
+    The score is how many of the people I follow follow them.
+    Complete rankings are cached, partial ones (cut short by the deadline)
+    are not, so the next request picks up from the warmed graph pages.
+    """
+    cached = await cache.get_data(SUGGESTIONS_PREFIX, me)
+    if cached is not None:
+        return (cached, False)
+
+    deadline = asyncio.get_running_loop().time() + FANOUT_DEADLINE
     my_following = await get_following_handles(client, me)
     my_following.sort()
-    my_following_to_check = my_following[index:next_index]
+    store, partial = await _following_graph(
+        client, me, my_following[:SUGGESTIONS_SOURCES], deadline
+    )
+    counts = store.follower_counts()
 
-    suggestions = []
-
-    # For everyone that I follow,
-    for my_follow in my_following_to_check:
-        # List of who they follow
-        following = await get_following_handles(client, my_follow)
-
-        # And remove the people I follow
-        for thier_follow in following:
-            thier_follow.strip().lower()
-            if (
-                thier_follow
-                and thier_follow is not me
-                and thier_follow not in my_following
-                and thier_follow != "handle.invalid"
-                and thier_follow != "bsky.app"
-            ):
-                # Then add them to the suggestions
-                suggestions.append(thier_follow)
+    # Drop the people I follow, through the interned ids rather than list lookups
+    store.exclude(counts, graph.IGNORED_HANDLES)
+    store.exclude(counts, my_following)
+    store.exclude(counts, [me])
+    ranked = tuple(store.ranked(counts))
+
+    if not partial:
+        ranked = await cache.set_data(SUGGESTIONS_PREFIX, me, ranked, tags=(GRAPH_TAG,))
+    return (ranked, partial)
 
-    # return -1 next index (indicating the we are done) if we are at the end of the list
-    next_index = next_index if next_index < SUGGESTIONS_PER_PAGE * MAX_SUGGESTION_PAGES else -1
 
-    return (suggestions, next_index)
+def _suggestions_cursor(entry: tuple[str, int]) -> str:
+    handle, score = entry
+    return f"{score}-{handle}"
 
 
-_BSKY_BASE = "https://bsky.social/xrpc"
-_BSKY_TIMEOUT = 10
+def _parse_suggestions_cursor(cursor: str) -> tuple[int, str]:
+    """The (-score, handle) sort key of the last entry on the previous page."""
+    score, _, handle = cursor.partition("-")
+    if not score.isdigit() or not handle:
+        raise ValueError(f"invalid suggestions cursor {cursor!r}")
+    return (-int(score), handle)
 
 
-def _bsky_get(client: atproto.Client, endpoint: str, params: dict) -> requests.Response:
-    """Shared call shape: bearer auth from the atproto session, fixed timeout,
+async def suggestions(
+    client: atproto.Client, me: str, cursor: str = ""
+) -> tuple[list[dict[str, typing.Any]], str | None, bool]:
+    """
+    For everyone that I follow,
+    list who they follow that I don't follow,
+    once each, most followed first, SUGGESTIONS_PER_PAGE at a time.
+    The cursor is the last entry of the previous page rather than an offset,
+    so pages stay in step even when the ranking is rebuilt between them.
+    The second value is the next cursor, None on the last page.
+    The third value is True if the deadline cut the aggregation short.
+    """
+    ranked, partial = await _ranked_suggestions(client, me)
+    start = 0
+    if cursor:
+        after = _parse_suggestions_cursor(cursor)
+        start = bisect.bisect_right(ranked, after, key=lambda entry: (-entry[1], entry[0]))
+    page = ranked[start : start + SUGGESTIONS_PER_PAGE]
+    next_cursor = None
+    if page and start + len(page) < len(ranked):
+        next_cursor = _suggestions_cursor(page[-1])
+    return ([{"handle": handle, "score": score} for handle, score in page], next_cursor, partial)
+
+
+async def _bsky_get(client: atproto.Client, endpoint: str, params: dict) -> httpx.Response:
+    """Shared call shape: bearer auth from the atproto session, pooled client,
     raise_for_status. Returns the raw Response so cache.get_or_return_cached_request
     can read .json() / .status_code through its existing interface."""
-    response = requests.get(
-        f"{_BSKY_BASE}/{endpoint}",
-        params=params,
-        headers={"Authorization": f"Bearer {client._session.access_jwt}"},
-        timeout=_BSKY_TIMEOUT,
-    )
+    response = await xrpc.XrpcClient().get(endpoint, params, client._session.access_jwt)
     response.raise_for_status()
     return response
 
@@ -152,31 +376,94 @@ async def get_profile(client: atproto.Client, handle: str) -> dict[str, dict]:
     return {output["did"]: output}
 
 
+@dataclasses.dataclass(frozen=True)
+class GraphRelation:
+    """
+    One side of the follow graph, and where its canonical pages are cached.
+    Every view of a relation (DID-keyed profiles, handle lists, ...) is a
+    projection of these same cached pages, so the views can't disagree and
+    each page is only fetched and stored once.
+    """
+
+    prefix: str
+    endpoint: str
+    key: str
+
+
+# Cache tags, for bulk invalidation with `cache.delete_tag`
+GRAPH_TAG = "graph"
+FEED_TAG = "feed"
+
+FOLLOWERS = GraphRelation("bsky.graph-followers", "app.bsky.graph.getFollowers", "followers")
+FOLLOWING = GraphRelation("bsky.graph-following", "app.bsky.graph.getFollows", "follows")
+
+
+async def iter_graph_pages(
+    client: atproto.Client, relation: GraphRelation, handle: str
+) -> typing.AsyncIterator[tuple[dict[str, typing.Any], ...]]:
+    """
+    Walk the cursor of a graph `relation` for `handle`, up to MAX_FOLLOWS_PAGES,
+    yielding the profiles of each page as soon as it has been fetched.
+    Every page is cached on its own under its cursor,
+    so a crawl that gets interrupted picks up from the cache where it stopped.
+    """
+    cursor = ""
+    for _ in range(MAX_FOLLOWS_PAGES):
+        params = {"actor": handle, "limit": 100}
+        if cursor:
+            params["cursor"] = cursor
+        output = await cache.get_or_return_cached_request(
+            f"{relation.prefix}-{cursor}",
+            handle,
+            functools.partial(_bsky_get, client, relation.endpoint, params),
+            tags=(GRAPH_TAG,),
+        )
+        yield output.get(relation.key, ())
+        cursor = output.get("cursor", "")
+        if not cursor:
+            break
+
+
+def iter_followers_pages(
+    client: atproto.Client, handle: str
+) -> typing.AsyncIterator[tuple[dict[str, typing.Any], ...]]:
+    return iter_graph_pages(client, FOLLOWERS, handle)
+
+
+def iter_following_pages(
+    client: atproto.Client, handle: str
+) -> typing.AsyncIterator[tuple[dict[str, typing.Any], ...]]:
+    return iter_graph_pages(client, FOLLOWING, handle)
+
+
+async def _profiles_by_did(
+    client: atproto.Client, relation: GraphRelation, handle: str
+) -> dict[str, typing.Any]:
+    return {
+        profile["did"]: profile
+        async for page in iter_graph_pages(client, relation, handle)
+        for profile in page
+    }
+
+
+async def _handles(client: atproto.Client, relation: GraphRelation, handle: str) -> list[str]:
+    return [
+        profile["handle"]
+        async for page in iter_graph_pages(client, relation, handle)
+        for profile in page
+    ]
+
+
 async def get_followers(client: atproto.Client, handle: str) -> dict[str, typing.Any]:
-    output = await cache.get_or_return_cached_request(
-        "bsky.get-followers",
-        handle,
-        lambda: _bsky_get(client, "app.bsky.graph.getFollowers", {"actor": handle, "limit": 100}),
-    )
-    return {profile["did"]: profile for profile in output.get("followers", [])}
+    return await _profiles_by_did(client, FOLLOWERS, handle)
 
 
 async def get_following(client: atproto.Client, handle: str) -> dict[str, typing.Any]:
-    output = await cache.get_or_return_cached_request(
-        "bsky.get-following",
-        handle,
-        lambda: _bsky_get(client, "app.bsky.graph.getFollows", {"actor": handle, "limit": 100}),
-    )
-    return {profile["did"]: profile for profile in output.get("follows", [])}
+    return await _profiles_by_did(client, FOLLOWING, handle)
 
 
 async def get_following_handles(client: atproto.Client, handle: str) -> list[str]:
-    output = await cache.get_or_return_cached_request(
-        "bsky.get-following-handles",
-        handle,
-        lambda: _bsky_get(client, "app.bsky.graph.getFollows", {"actor": handle, "limit": 100}),
-    )
-    return [profile["handle"] for profile in output.get("follows", [])]
+    return await _handles(client, FOLLOWING, handle)
 
 
 async def get_author_feed(
@@ -188,13 +475,21 @@ async def get_author_feed(
         lambda: _bsky_get(
             client, "app.bsky.feed.getAuthorFeed", {"actor": handle, "limit": 100, "cursor": cursor}
         ),
+        tags=(FEED_TAG,),
     )
     return (output.get("feed", []), output.get("cursor", ""))
 
 
-async def get_author_feed_text(
+# Called with (page number, posts on the page) as feed pages come in.
+PageCallback = typing.Callable[[int, int], None]
+
+
+async def get_author_feed_posts(
     client: atproto.Client, handle: str, cursor: str = ""
-) -> tuple[list[str], str]:
+) -> tuple[list[dict[str, str]], str]:
+    """
+    One page of the author's posts, newest first, as {"uri", "text"} dicts.
+    """
     feed_data = await cache.get_or_return_cached_request(
         f"bsky.get-author-feed-text-{cursor}",
         handle,
@@ -203,26 +498,63 @@ async def get_author_feed_text(
             "app.bsky.feed.getAuthorFeed",
             {"actor": handle, "limit": 100, "filter": "posts_no_replies", "cursor": cursor},
         ),
+        tags=(FEED_TAG,),
     )
     return (
-        [post["post"]["record"]["text"] for post in feed_data.get("feed", [])],
+        [
+            {"uri": post["post"]["uri"], "text": post["post"]["record"]["text"]}
+            for post in feed_data.get("feed", [])
+        ],
         feed_data.get("cursor", ""),
     )
 
 
-async def get_author_feed_texts(client: atproto.Client, handle: str, pages: int = 1) -> list[str]:
+async def get_author_feed_text(
+    client: atproto.Client, handle: str, cursor: str = ""
+) -> tuple[list[str], str]:
+    posts, cursor = await get_author_feed_posts(client, handle, cursor)
+    return ([post["text"] for post in posts], cursor)
+
+
+async def iter_author_feed_posts(
+    client: atproto.Client, handle: str, pages: int = 1, fresh: bool = False
+) -> typing.AsyncGenerator[list[dict[str, str]]]:
+    """
+    The author's posts page by page, newest first, going back a number of pages.
+    Pipelined: the next page is requested as soon as this one's cursor is known,
+    so it downloads while the caller works on this one.
+    With `fresh`, the first page skips the cache, so posts made since it was
+    cached show up. Deeper pages are keyed by cursor, so they follow along.
+    Close it (ex. contextlib.aclosing) when stopping early, to cancel that request.
+    """
+    if fresh:
+        await cache.delete_data("bsky.get-author-feed-text-", handle)
+    fetch = asyncio.ensure_future(get_author_feed_posts(client, handle, ""))
+    try:
+        for page in range(pages):
+            posts, cursor = await fetch
+            more = bool(cursor) and page + 1 < pages
+            if more:
+                fetch = asyncio.ensure_future(get_author_feed_posts(client, handle, cursor))
+            yield posts
+            if not more:
+                return
+    finally:
+        fetch.cancel()
+
+
+async def get_author_feed_texts(
+    client: atproto.Client, handle: str, pages: int = 1, on_page: PageCallback | None = None
+) -> list[str]:
     """
     Get the text of the author's feed, going back a number of pages.
     """
-    page = 0
     texts = []
-    cursor = ""
-    while page < pages:
-        page_texts, cursor = await get_author_feed_text(client, handle, cursor)
-        print(f"cursor: {cursor}")
-        texts += page_texts
-        if not cursor:
-            break
+    page = 0
+    async for posts in iter_author_feed_posts(client, handle, pages):
+        texts += [post["text"] for post in posts]
+        if on_page is not None:
+            on_page(page, len(posts))
         page += 1
     return texts
 
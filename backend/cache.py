@@ -1,38 +1,769 @@
+import abc
 import asyncio
+import collections
 import dataclasses
 import enum
+import heapq
 import json
 import logging
+import os
+import re
 import sys
+import threading
 import time
 import typing
 
-import requests  # type: ignore
+import httpx
+import opentelemetry.trace as otel_trace
+import redis
 import structlog
 
-from . import telemetry
+from . import db, telemetry
 
 _telemetry = telemetry.Telemetry()
 logger = structlog.get_logger()
 logging.basicConfig(stream=sys.stdout)
 
 
-_store: dict[str, tuple[float, str]] = {}
+@dataclasses.dataclass(frozen=True)
+class CachePolicy:
+    """
+    How long entries under a prefix live, in seconds.
+    `ttl` is the hard limit, after which an entry is gone.
+    `stale_after` is the optional soft limit: past it, the stale value is still
+    served immediately, and a background refresh is scheduled.
+    """
+
+    ttl: int
+    stale_after: int | None = None
+
+
+# Per-prefix cache policies. Prefixes are matched longest-first, so
+# cursor-suffixed prefixes like `bsky.get-author-feed-{cursor}` resolve to their
+# base entry. Anything unlisted falls back to `DEFAULT_POLICY`.
+DAY = 86400
+DEFAULT_POLICY = CachePolicy(ttl=DAY)
+PREFIX_POLICIES: dict[str, CachePolicy] = {
+    "bsky.get-profile": CachePolicy(ttl=DAY, stale_after=60 * 60),
+    "bsky.graph-followers": CachePolicy(ttl=7 * DAY, stale_after=DAY),
+    "bsky.graph-following": CachePolicy(ttl=7 * DAY, stale_after=DAY),
+    # Also covers the text variant
+    "bsky.get-author-feed": CachePolicy(ttl=DAY, stale_after=60 * 15),
+    "tasks.bsky": CachePolicy(ttl=60 * 60),
+    "emoji-summary": CachePolicy(ttl=DAY),
+    # Long enough to poll the result, short enough that the next refresh runs again
+    "emoji-summary-incremental": CachePolicy(ttl=60),
+    # Incremental emoji-summary state, see `worker.process_emoji_summary_incremental`
+    "emoji-summary-state": CachePolicy(ttl=7 * DAY),
+    # Ranked suggestions, see `bsky.suggestions`
+    "bsky.suggestions": CachePolicy(ttl=60 * 60),
+    # Materialized popularity, see `bsky.build_popularity_view`
+    "bsky.popularity-view": CachePolicy(ttl=7 * DAY),
+    "bsky.popularity-graph": CachePolicy(ttl=7 * DAY),
+}
+
+# Rough per-entry bookkeeping cost (OrderedDict node, entry object, heap tuple),
+# added on top of the key and value sizes when charging the byte budget.
+_ENTRY_OVERHEAD = 200
+
+
+# Prefixes of paged keys, `{prefix}-{cursor}-{suffix}`. Their keys are labelled
+# with the prefix alone, so the prefix indexes grow with the distinct prefixes in
+# use rather than with every cursor ever seen. Matched longest-first.
+PAGED_PREFIXES = (
+    "bsky.get-author-feed-text",
+    "bsky.get-author-feed",
+    "bsky.graph-followers",
+    "bsky.graph-following",
+)
+
+
+def label_prefix(prefix: str) -> str:
+    """The prefix `prefix` is indexed under, with any cursor dropped."""
+    for paged_prefix in PAGED_PREFIXES:
+        if prefix.startswith(f"{paged_prefix}-"):
+            return paged_prefix
+    return prefix
+
+
+def policy_for(prefix: str) -> CachePolicy:
+    for known_prefix in sorted(PREFIX_POLICIES, key=len, reverse=True):
+        if prefix.startswith(known_prefix):
+            return PREFIX_POLICIES[known_prefix]
+    return DEFAULT_POLICY
+
+
+class FrozenDict(dict):
+    """
+    A dict that refuses mutation.
+    Cached values are handed to every reader as-is, so they must not be edited.
+    Still a real dict, so `json.dumps` and FastAPI serialize it unchanged.
+    """
+
+    def _read_only(self, *args, **kwargs) -> typing.NoReturn:
+        raise TypeError("cached values are read-only, copy them before editing")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # The default dict pickling path rebuilds via __setitem__.
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value: typing.Any) -> tuple[typing.Any, int]:
+    """
+    Convert a decoded JSON value into its read-only form
+    (dicts to FrozenDict, lists to tuples),
+    returning it along with its approximate size in bytes.
+    """
+    if isinstance(value, dict):
+        size = sys.getsizeof(value)
+        frozen = {}
+        for key, item in value.items():
+            frozen[key], item_size = freeze(item)
+            size += sys.getsizeof(key) + item_size
+        return FrozenDict(frozen), size
+    if isinstance(value, list | tuple):
+        items = []
+        size = sys.getsizeof(value)
+        for item in value:
+            frozen_item, item_size = freeze(item)
+            items.append(frozen_item)
+            size += item_size
+        return tuple(items), size
+    return value, sys.getsizeof(value)
 
 
-def _get(key: str) -> str | None:
-    entry = _store.get(key)
-    if entry is None:
-        return None
-    expires_at, value = entry
-    if expires_at < time.time():
-        _store.pop(key, None)
-        return None
-    return value
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+    def to_dict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class KeyLabels:
+    """
+    What a key can be invalidated by: the prefix and suffix it was built from
+    (`{prefix}-{suffix}`, the suffix is usually a handle), and any tags.
+    The prefix is the `label_prefix`, without the cursor of paged keys.
+    Every tier indexes keys by these, so invalidation only touches matching keys.
+    """
+
+    prefix: str
+    suffix: str
+    tags: tuple[str, ...] = ()
+
+
+@dataclasses.dataclass(slots=True)
+class CacheEntry:
+    value: typing.Any
+    size: int
+    expires_at: float
+    stale_at: float | None = None
+    labels: KeyLabels | None = None
+
+    def is_stale(self) -> bool:
+        return self.stale_at is not None and self.stale_at < time.time()
+
+
+class CacheTier(abc.ABC):
+    """
+    One level of cache storage. `_get` / `_set` read through and write to every
+    configured tier, in-process memory first (L1), then the optional L2.
+    """
+
+    stats: CacheStats
+
+    @abc.abstractmethod
+    def get(self, key: str) -> CacheEntry | None: ...
+
+    @abc.abstractmethod
+    def set(
+        self,
+        key: str,
+        value: typing.Any,
+        ex: int,
+        size: int,
+        stale_after: int | None = None,
+        labels: KeyLabels | None = None,
+    ) -> None: ...
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> bool: ...
+
+    @abc.abstractmethod
+    def delete_suffix(self, suffix: str) -> list[str]:
+        """Delete every key whose labels have this exact `suffix`, returning them."""
+
+    @abc.abstractmethod
+    def delete_prefix(self, prefix: str) -> list[str]:
+        """Delete every key whose labelled prefix starts with `prefix`, returning them."""
+
+    @abc.abstractmethod
+    def delete_tag(self, tag: str) -> list[str]:
+        """Delete every key labelled with `tag`, returning them."""
+
+    def get_many(self, keys: list[str]) -> list[CacheEntry | None]:
+        """`get` for every key, in order. Networked tiers do it in one round trip."""
+        return [self.get(key) for key in keys]
+
+    def refresh_stats(self) -> CacheStats:
+        """Stats, with entries and bytes brought up to date where that takes a query."""
+        return self.stats
+
+
+class MemoryStore(CacheTier):
+    """
+    Bounded in-process key/value store.
+    Values are kept decoded, so a hit is a dictionary lookup with no parsing.
+    Entries are evicted least-recently-used first once either the byte budget
+    or the entry cap is exceeded, and expired entries are removed by a
+    background sweeper rather than waiting for the same key to be read again.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int, sweep_interval: float):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.stats = CacheStats()
+        self._entries: collections.OrderedDict[str, CacheEntry] = collections.OrderedDict()
+        self._expiry_heap: list[tuple[float, str]] = []
+        # Secondary indexes from labels to keys, kept in step by `set` / `_remove`
+        self._by_suffix: dict[str, set[str]] = collections.defaultdict(set)
+        self._by_prefix: dict[str, set[str]] = collections.defaultdict(set)
+        self._by_tag: dict[str, set[str]] = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self._sweeper: threading.Thread | None = None
+
+    def get(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            if entry.expires_at < time.time():
+                self._remove(key)
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry
+
+    def set(
+        self,
+        key: str,
+        value: typing.Any,
+        ex: int,
+        size: int,
+        stale_after: int | None = None,
+        labels: KeyLabels | None = None,
+    ) -> None:
+        size += sys.getsizeof(key) + _ENTRY_OVERHEAD
+        now = time.time()
+        expires_at = now + ex
+        stale_at = now + stale_after if stale_after is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            # Don't flush the whole cache to make room for something that can never fit.
+            if size > self.max_bytes:
+                logger.info("cache", adjective="too-large", key=key, size=size)
+                return
+            self._entries[key] = CacheEntry(value, size, expires_at, stale_at, labels)
+            if labels is not None:
+                self._by_suffix[labels.suffix].add(key)
+                self._by_prefix[labels.prefix].add(key)
+                for tag in labels.tags:
+                    self._by_tag[tag].add(key)
+            self.stats.entries += 1
+            self.stats.bytes += size
+            heapq.heappush(self._expiry_heap, (expires_at, key))
+            self._evict()
+        self._ensure_sweeper()
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._remove(key)
+
+    def delete_suffix(self, suffix: str) -> list[str]:
+        with self._lock:
+            return self._remove_all(self._by_suffix.get(suffix, ()))
+
+    def delete_prefix(self, prefix: str) -> list[str]:
+        # Walks the distinct prefixes (cursors aren't part of them), not the keys
+        with self._lock:
+            matching = [
+                key
+                for known_prefix, keys in self._by_prefix.items()
+                if known_prefix.startswith(prefix)
+                for key in keys
+            ]
+            return self._remove_all(matching)
+
+    def delete_tag(self, tag: str) -> list[str]:
+        with self._lock:
+            return self._remove_all(self._by_tag.get(tag, ()))
+
+    def _remove_all(self, keys: typing.Iterable[str]) -> list[str]:
+        deleted = list(keys)
+        for key in deleted:
+            self._remove(key)
+        return deleted
+
+    def sweep(self) -> int:
+        """Remove every expired entry, returning how many were removed."""
+        removed = 0
+        now = time.time()
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] < now:
+                expires_at, key = heapq.heappop(self._expiry_heap)
+                entry = self._entries.get(key)
+                # Heap items are never updated in place, so skip the ones
+                # left behind by keys that have since been overwritten.
+                if entry is not None and entry.expires_at == expires_at:
+                    self._remove(key)
+                    removed += 1
+            self.stats.expirations += removed
+            # Compact the heap when overwrites have left it mostly stale.
+            if len(self._expiry_heap) > 2 * len(self._entries) + 1024:
+                self._expiry_heap = [(e.expires_at, k) for k, e in self._entries.items()]
+                heapq.heapify(self._expiry_heap)
+        return removed
+
+    def _remove(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        if entry.labels is not None:
+            _unindex(self._by_suffix, entry.labels.suffix, key)
+            _unindex(self._by_prefix, entry.labels.prefix, key)
+            for tag in entry.labels.tags:
+                _unindex(self._by_tag, tag, key)
+        self.stats.entries -= 1
+        self.stats.bytes -= entry.size
+        return True
+
+    def _evict(self) -> None:
+        while self._entries and (
+            self.stats.bytes > self.max_bytes or len(self._entries) > self.max_entries
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.stats.evictions += 1
+            logger.info("cache", adjective="evict", key=key)
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._sweeper = threading.Thread(
+            target=self._sweep_forever, name="cache-sweeper", daemon=True
+        )
+        self._sweeper.start()
+
+    def _sweep_forever(self) -> None:
+        while True:
+            time.sleep(self.sweep_interval)
+            removed = self.sweep()
+            if removed:
+                logger.info("cache", adjective="sweep", removed=removed, **self.stats.to_dict())
+
+
+def _unindex(index: dict[str, set[str]], label: str, key: str) -> None:
+    keys = index.get(label)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[label]
+
+
+class SQLiteStore(CacheTier):
+    """
+    Persistent cache tier in a SQLite database in WAL mode, so entries survive
+    restarts and every process on the machine (ex. uvicorn workers) shares them.
+    Values are stored as JSON, and decoded again on every read, which is why
+    this sits behind the memory tier rather than replacing it.
+    Calls block on disk, so async code runs them through asyncio.to_thread.
+    """
+
+    def __init__(self, path: str, sweep_interval: float):
+        self.sweep_interval = sweep_interval
+        self.stats = CacheStats()
+        self._last_sweep = time.time()
+        # It's only a cache, so NORMAL: a power loss may drop the last writes
+        self._conn = db.connect(path, synchronous="NORMAL")
+        self._lock = threading.Lock()
+        with self._lock:
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(cache)")}
+            if columns and "suffix" not in columns:
+                # Written before keys were labelled. It's only a cache, start over.
+                self._conn.execute("DROP TABLE cache")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    stale_at REAL,
+                    prefix TEXT,
+                    suffix TEXT,
+                    tags TEXT
+                );
+                CREATE INDEX IF NOT EXISTS cache_prefix ON cache (prefix);
+                CREATE INDEX IF NOT EXISTS cache_suffix ON cache (suffix);
+                CREATE TABLE IF NOT EXISTS cache_tags (
+                    tag TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    PRIMARY KEY (tag, key)
+                ) WITHOUT ROWID;
+                """
+            )
+
+    def get(self, key: str) -> CacheEntry | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at, stale_at, prefix, suffix, tags FROM cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None or row[1] < time.time():
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+        (value, expires_at, stale_at, prefix, suffix, tags) = row
+        labels = None if prefix is None else KeyLabels(prefix, suffix, tuple(json.loads(tags)))
+        return CacheEntry(json.loads(value), len(value), expires_at, stale_at, labels)
+
+    def set(
+        self,
+        key: str,
+        value: typing.Any,
+        ex: int,
+        size: int,
+        stale_after: int | None = None,
+        labels: KeyLabels | None = None,
+    ) -> None:
+        encoded = json.dumps(value)
+        now = time.time()
+        stale_at = now + stale_after if stale_after is not None else None
+        prefix, suffix, tags = (
+            (labels.prefix, labels.suffix, list(labels.tags)) if labels else (None, None, [])
+        )
+        with self._lock, db.immediate(self._conn):
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache "
+                "(key, value, expires_at, stale_at, prefix, suffix, tags) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, encoded, now + ex, stale_at, prefix, suffix, json.dumps(tags)),
+            )
+            self._conn.execute("DELETE FROM cache_tags WHERE key = ?", (key,))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)",
+                [(tag, key) for tag in tags],
+            )
+            if now - self._last_sweep > self.sweep_interval:
+                self._last_sweep = now
+                self.stats.expirations += len(self._delete_where("expires_at < ?", (now,)))
+
+    def delete(self, key: str) -> bool:
+        with self._lock, db.immediate(self._conn):
+            return bool(self._delete_where("key = ?", (key,)))
+
+    def delete_suffix(self, suffix: str) -> list[str]:
+        with self._lock, db.immediate(self._conn):
+            return self._delete_where("suffix = ?", (suffix,))
+
+    def delete_prefix(self, prefix: str) -> list[str]:
+        # GLOB with a literal lead can use the prefix index, LIKE (case-insensitive) can't
+        pattern = re.sub(r"([*?\[])", r"[\1]", prefix) + "*"
+        with self._lock, db.immediate(self._conn):
+            return self._delete_where("prefix GLOB ?", (pattern,))
+
+    def delete_tag(self, tag: str) -> list[str]:
+        with self._lock, db.immediate(self._conn):
+            return self._delete_where("key IN (SELECT key FROM cache_tags WHERE tag = ?)", (tag,))
+
+    def _delete_where(self, where: str, params: tuple) -> list[str]:
+        """
+        Delete matching rows and their tags, returning the keys.
+        Hold the lock, inside a `db.immediate` transaction.
+        """
+        rows = self._conn.execute(f"DELETE FROM cache WHERE {where} RETURNING key", params)
+        deleted = [key for (key,) in rows.fetchall()]
+        self._conn.executemany("DELETE FROM cache_tags WHERE key = ?", [(k,) for k in deleted])
+        return deleted
+
+    def refresh_stats(self) -> CacheStats:
+        with self._lock:
+            (entries, size) = self._conn.execute(
+                "SELECT count(*), coalesce(sum(length(value)), 0) FROM cache"
+            ).fetchone()
+        self.stats.entries = entries
+        self.stats.bytes = size
+        return self.stats
+
+
+class RedisStore(CacheTier):
+    """
+    Shared cache tier on a Redis-compatible server, so every replica of the
+    Deployment reads the entries any one of them fetched.
+    Connections come from a pool, expiry is left to Redis (SET PX), and
+    bulk reads are a single MGET. Values are JSON, like SQLiteStore.
+    Labels are indexed in one sorted set per suffix / prefix / tag, scored by
+    expiry and written in the same pipeline as the value. Every write also
+    prunes the expired members of the sets it touches, and invalidation only
+    reads the live ones, so the indexes track the keys that still exist.
+    Calls block on the network, so async code runs them through asyncio.to_thread.
+    """
+
+    def __init__(self, url: str, namespace: str, max_connections: int):
+        self.namespace = namespace
+        self.stats = CacheStats()
+        self._prefixes_key = f"{namespace}zindex:prefixes"
+        self._dropped_legacy_index = False
+        self._redis = redis.Redis(
+            connection_pool=redis.BlockingConnectionPool.from_url(
+                url, max_connections=max_connections, timeout=5, decode_responses=True
+            )
+        )
+
+    def _decode(self, raw: str | bytes | None) -> CacheEntry | None:
+        if raw is None:
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        (expires_at, stale_at, value, labels) = json.loads(raw)
+        if labels is not None:
+            labels = KeyLabels(labels[0], labels[1], tuple(labels[2]))
+        return CacheEntry(value, len(raw), expires_at, stale_at, labels)
+
+    def _index_key(self, kind: str, label: str) -> str:
+        return f"{self.namespace}zindex:{kind}:{label}"
+
+    def _pipeline_set(
+        self,
+        pipeline: redis.client.Pipeline,
+        key: str,
+        value: typing.Any,
+        ex: int,
+        stale_after: int | None,
+        labels: KeyLabels | None,
+    ) -> None:
+        """Queue the write of `key` (expiry times travel with the value) and its index entries."""
+        now = time.time()
+        expires_at = now + ex
+        stale_at = now + stale_after if stale_after is not None else None
+        encoded_labels = None
+        if labels is not None:
+            encoded_labels = [labels.prefix, labels.suffix, list(labels.tags)]
+        encoded = json.dumps([expires_at, stale_at, value, encoded_labels])
+        pipeline.set(self.namespace + key, encoded, px=max(int(ex * 1000), 1))
+        if not self._dropped_legacy_index:
+            # The unscored prefix registry of earlier versions, which had no TTL
+            pipeline.unlink(f"{self.namespace}index:prefixes")
+            self._dropped_legacy_index = True
+        if labels is None:
+            return
+        index_keys = [
+            self._index_key("suffix", labels.suffix),
+            self._index_key("prefix", labels.prefix),
+            *(self._index_key("tag", tag) for tag in labels.tags),
+        ]
+        for index_key in index_keys:
+            pipeline.zadd(index_key, {key: expires_at})
+            self._pipeline_prune(pipeline, index_key, now, ex)
+        # Scored by the expiry of the prefix's longest-lived key
+        pipeline.zadd(self._prefixes_key, {labels.prefix: expires_at}, gt=True)
+        self._pipeline_prune(pipeline, self._prefixes_key, now, ex)
+
+    def _pipeline_prune(
+        self, pipeline: redis.client.Pipeline, index_key: str, now: float, ex: int
+    ) -> None:
+        pipeline.zremrangebyscore(index_key, "-inf", now)
+        # Live as long as the longest-lived member
+        pipeline.expire(index_key, ex, nx=True)
+        pipeline.expire(index_key, ex, gt=True)
+
+    def get(self, key: str) -> CacheEntry | None:
+        return self._decode(self._redis.get(self.namespace + key))
+
+    def get_many(self, keys: list[str]) -> list[CacheEntry | None]:
+        if not keys:
+            return []
+        return [self._decode(raw) for raw in self._redis.mget([self.namespace + k for k in keys])]
+
+    def set(
+        self,
+        key: str,
+        value: typing.Any,
+        ex: int,
+        size: int,
+        stale_after: int | None = None,
+        labels: KeyLabels | None = None,
+    ) -> None:
+        # Pipelined with its index entries, so one round trip
+        pipeline = self._redis.pipeline(transaction=False)
+        self._pipeline_set(pipeline, key, value, ex, stale_after, labels)
+        pipeline.execute()
+
+    def delete(self, key: str) -> bool:
+        return bool(self._redis.unlink(self.namespace + key))
+
+    def _delete_indexed(self, index_keys: list[str]) -> list[str]:
+        """Delete every live key listed in the `index_keys` sets, and the sets themselves."""
+        now = time.time()
+        pipeline = self._redis.pipeline(transaction=False)
+        for index_key in index_keys:
+            pipeline.zrange(index_key, now, "+inf", byscore=True)
+        keys = sorted({key for members in pipeline.execute() for key in members})
+        pipeline = self._redis.pipeline(transaction=False)
+        for key in keys:
+            pipeline.unlink(self.namespace + key)
+        if index_keys:
+            pipeline.unlink(*index_keys)
+        unlinked = pipeline.execute()
+        # Members whose keys were deleted since, directly or through another index
+        return [key for key, count in zip(keys, unlinked, strict=False) if count]
+
+    def delete_suffix(self, suffix: str) -> list[str]:
+        return self._delete_indexed([self._index_key("suffix", suffix)])
+
+    def delete_prefix(self, prefix: str) -> list[str]:
+        known_prefixes: list[str] = self._redis.zrange(  # type: ignore[assignment]
+            self._prefixes_key, time.time(), "+inf", byscore=True
+        )
+        matching = [p for p in known_prefixes if p.startswith(prefix)]
+        deleted = self._delete_indexed([self._index_key("prefix", p) for p in matching])
+        if matching:
+            self._redis.zrem(self._prefixes_key, *matching)
+        return deleted
+
+    def delete_tag(self, tag: str) -> list[str]:
+        return self._delete_indexed([self._index_key("tag", tag)])
+
+    def refresh_stats(self) -> CacheStats:
+        # Server wide, the namespace may not be the only thing in there
+        self.stats.entries = int(self._redis.dbsize())
+        self.stats.bytes = int(self._redis.info("memory")["used_memory"])
+        return self.stats
+
+
+_store = MemoryStore(
+    max_bytes=int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    max_entries=int(os.getenv("CACHE_MAX_ENTRIES", "50000")),
+    sweep_interval=float(os.getenv("CACHE_SWEEP_INTERVAL", "60")),
+)
+
+# Optional second tier behind `_store`: "sqlite", or unset for memory only.
+# "redis" for a tier shared by every replica, at CACHE_REDIS_URL.
+CACHE_L2 = os.getenv("CACHE_L2", "").lower().strip()
+CACHE_L2_PATH = os.getenv("CACHE_L2_PATH", ".cache/cache.sqlite3")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_REDIS_NAMESPACE = os.getenv("CACHE_REDIS_NAMESPACE", "backend:")
+CACHE_REDIS_MAX_CONNECTIONS = int(os.getenv("CACHE_REDIS_MAX_CONNECTIONS", "20"))
+
+_l2: CacheTier | None = None
+if CACHE_L2 == "sqlite":
+    _l2 = SQLiteStore(CACHE_L2_PATH, _store.sweep_interval)
+elif CACHE_L2 == "redis":
+    _l2 = RedisStore(CACHE_REDIS_URL, CACHE_REDIS_NAMESPACE, CACHE_REDIS_MAX_CONNECTIONS)
+elif CACHE_L2:
+    raise ValueError(f"unknown CACHE_L2 backend {CACHE_L2!r}")
+
+
+# Upstream fetches currently running, keyed by cache key. See `_single_flight`.
+_inflight: dict[str, asyncio.Future] = {}
+
+# Stale-while-revalidate refreshes, held here so they aren't garbage collected mid-flight.
+_background_refreshes: set[asyncio.Future] = set()
+
+
+def _promote(key: str, entry: CacheEntry) -> CacheEntry:
+    """Copy an L2 entry into the memory tier, keeping its expiry times."""
+    frozen, size = freeze(entry.value)
+    now = time.time()
+    stale_after = None if entry.stale_at is None else max(int(entry.stale_at - now), 0)
+    _store.set(key, frozen, int(entry.expires_at - now), size, stale_after, entry.labels)
+    return CacheEntry(frozen, size, entry.expires_at, entry.stale_at, entry.labels)
+
+
+async def _get_entry(key: str, shared: bool = False) -> CacheEntry | None:
+    """
+    Look `key` up in memory, then in L2 (off the event loop).
+    With `shared`, skip the memory tier when there is an L2, for values that
+    another process may have changed since (ex. task status).
+    """
+    entry = None if shared and _l2 is not None else _store.get(key)
+    if entry is None and _l2 is not None:
+        entry = await asyncio.to_thread(_l2.get, key)
+        if entry is not None:
+            entry = _promote(key, entry)
+    return entry
+
+
+async def _get(key: str, shared: bool = False) -> typing.Any | None:
+    entry = await _get_entry(key, shared)
+    return entry.value if entry is not None else None
+
+
+async def prefetch(keys: list[str]) -> dict[str, typing.Any]:
+    """
+    Warm the memory tier with whichever of `keys` L2 has, in one bulk read
+    (one MGET against Redis) instead of a round trip per key.
+    Returns the value of every key that is now cached, from either tier.
+    """
+    values = {}
+    missing = []
+    for key in keys:
+        entry = _store.get(key)
+        if entry is None:
+            missing.append(key)
+        else:
+            values[key] = entry.value
+    if missing and _l2 is not None:
+        entries = await asyncio.to_thread(_l2.get_many, missing)
+        for key, entry in zip(missing, entries, strict=True):
+            if entry is not None:
+                values[key] = _promote(key, entry).value
+    return values
+
+
+async def _set(
+    prefix: str, suffix: str, value: typing.Any, tags: tuple[str, ...] = ()
+) -> typing.Any:
+    """
+    Store a read-only copy of `value` under `{prefix}-{suffix}` in every tier,
+    indexed for invalidation by prefix, suffix and `tags`, and return that copy.
+    The L2 write, and its JSON encoding, happen off the event loop.
+    """
+    key = f"{prefix}-{suffix}"
+    policy = policy_for(prefix)
+    labels = KeyLabels(label_prefix(prefix), suffix, tags)
+    frozen, size = freeze(value)
+    _store.set(key, frozen, policy.ttl, size, policy.stale_after, labels)
+    if _l2 is not None:
+        await asyncio.to_thread(_l2.set, key, frozen, policy.ttl, size, policy.stale_after, labels)
+    return frozen
+
+
+async def _delete(key: str) -> None:
+    _store.delete(key)
+    if _l2 is not None:
+        await asyncio.to_thread(_l2.delete, key)
 
 
-def _set(key: str, value: str, ex: int) -> None:
-    _store[key] = (time.time() + ex, value)
+def stats() -> dict:
+    output = _store.stats.to_dict()
+    if _l2 is not None:
+        output["l2"] = _l2.refresh_stats().to_dict()
+    return output
 
 
 class TaskDataStatus(enum.Enum):
@@ -63,32 +794,116 @@ class AsyncTaskData:
         )
 
 
-def delete_keys(suffix: str) -> None:
-    for key in [k for k in _store if k.endswith(suffix)]:
-        _store.pop(key, None)
+def _delete_from_tiers(method: str, label: str) -> list[str]:
+    deleted = set(getattr(_store, method)(label))
+    if _l2 is not None:
+        deleted.update(getattr(_l2, method)(label))
+    for key in sorted(deleted):
         logger.info("cache", adjective="delete", key=key)
+    return sorted(deleted)
+
+
+def delete_keys(suffix: str) -> list[str]:
+    """Delete the keys cached for `suffix` (usually a handle), returning them."""
+    return _delete_from_tiers("delete_suffix", suffix)
+
+
+def delete_prefix(prefix: str) -> list[str]:
+    """
+    Delete the keys whose prefix starts with `prefix`, returning them.
+    `bsky.graph-following` covers every cursor page of every handle's follows.
+    """
+    return _delete_from_tiers("delete_prefix", prefix)
+
+
+def delete_tag(tag: str) -> list[str]:
+    """Delete the keys stored with `tag`, returning them."""
+    return _delete_from_tiers("delete_tag", tag)
+
+
+async def _single_flight[T](key: str, fetch: typing.Callable[[], typing.Awaitable[T]]) -> T:
+    """
+    Run `fetch` at most once per `key` at a time.
+    Concurrent callers for the same key await the in-flight call instead of
+    starting their own, and all of them receive its result or its exception.
+    The call runs as its own task, so one caller going away (ex. a client
+    disconnecting) doesn't cancel the fetch for everyone else.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _single_flight_done(key, done))
+    else:
+        logger.info("cache", adjective="coalesced", key=key)
+    return await asyncio.shield(task)
+
+
+def _single_flight_done(key: str, task: asyncio.Future) -> None:
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    # Mark the exception as retrieved, every waiter may have been cancelled.
+    if not task.cancelled():
+        task.exception()
+
+
+def _refresh_in_background(key: str, fetch: typing.Callable[[], typing.Awaitable]) -> None:
+    """Schedule a refresh of a stale entry, unless one is already running."""
+    if key in _inflight:
+        return
+    task = asyncio.ensure_future(_single_flight(key, fetch))
+    _background_refreshes.add(task)
+    task.add_done_callback(_background_refresh_done)
+
+
+def _background_refresh_done(task: asyncio.Future) -> None:
+    _background_refreshes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        # The stale value stays in place until its hard TTL runs out.
+        logger.error("cache", adjective="refresh-error", exc=task.exception())
+
+
+async def _read_through(
+    span: otel_trace.Span,
+    prefix: str,
+    suffix: str,
+    fetch: typing.Callable[[], typing.Awaitable],
+) -> typing.Any:
+    """
+    Shared hit / stale / miss handling.
+    Fresh hits are returned as-is, stale hits are returned as-is with a refresh
+    scheduled behind them, and misses wait for `fetch`.
+    """
+    key = f"{prefix}-{suffix}"
+    entry = await _get_entry(key)
+
+    if entry is None:
+        span.set_attribute("adjective", "miss")
+        return await _single_flight(key, fetch)
+
+    if entry.is_stale():
+        span.set_attribute("adjective", "stale")
+        logger.info("cache", adjective="stale", prefix=prefix, suffix=suffix, key=key)
+        _refresh_in_background(key, fetch)
+    else:
+        span.set_attribute("adjective", "hit")
+        logger.info("cache", adjective="hit", prefix=prefix, suffix=suffix, key=key)
+    return entry.value
 
 
 async def get_or_return_cached_request(
-    prefix: str, suffix: str, func: typing.Callable[[], requests.Response]
+    prefix: str,
+    suffix: str,
+    func: typing.Callable[[], typing.Awaitable[httpx.Response]],
+    tags: tuple[str, ...] = (),
 ) -> dict:
     key = f"{prefix}-{suffix}"
-    expiry = 86400  # 1 day
-    with _telemetry.tracer.start_as_current_span("get-or-return-cached-request") as span:
-        span.set_attribute("key", key)
-        span.set_attribute("prefix", prefix)
-        span.set_attribute("suffix", suffix)
-
-        output = _get(key)
 
-        if output is not None:
-            span.set_attribute("adjective", "hit")
-            logger.info("cache", adjective="hit", prefix=prefix, suffix=suffix, key=key)
-            return json.loads(output)
-        else:
-            span.set_attribute("adjective", "miss")
-            response = await asyncio.to_thread(func)
-            span.set_attribute("http.status_code", "response.status_code")
+    async def _fetch() -> dict:
+        with _telemetry.tracer.start_as_current_span("cached-request-fetch") as span:
+            span.set_attribute("key", key)
+            response = await func()
+            span.set_attribute("http.status_code", response.status_code)
             if response.status_code >= 500:
                 logger.error(
                     "cache",
@@ -98,12 +913,14 @@ async def get_or_return_cached_request(
                     key=key,
                     status_code=response.status_code,
                 )
-                raise requests.RequestException(
-                    f"Request failed with status code {response.status_code}"
+                raise httpx.HTTPStatusError(
+                    f"Request failed with status code {response.status_code}",
+                    request=response.request,
+                    response=response,
                 )
             try:
                 output_json = response.json()
-            except requests.exceptions.JSONDecodeError as exc:
+            except json.JSONDecodeError as exc:
                 logger.exception(
                     "request-cache",
                     adjective="error",
@@ -115,7 +932,7 @@ async def get_or_return_cached_request(
                 )
                 raise exc
 
-            _set(key, json.dumps(output_json), ex=expiry)
+            output_json = await _set(prefix, suffix, output_json, tags)
 
             logger.info(
                 "request-cache",
@@ -127,54 +944,72 @@ async def get_or_return_cached_request(
             )
             return output_json
 
+    with _telemetry.tracer.start_as_current_span("get-or-return-cached-request") as span:
+        span.set_attribute("key", key)
+        span.set_attribute("prefix", prefix)
+        span.set_attribute("suffix", suffix)
+        return await _read_through(span, prefix, suffix, _fetch)
+
 
-async def get_or_return_cached(prefix: str, suffix: str, func: typing.Callable) -> typing.Any:
+async def get_or_return_cached(
+    prefix: str, suffix: str, func: typing.Callable, tags: tuple[str, ...] = ()
+) -> typing.Any:
     key = f"{prefix}-{suffix}"
-    expiry = 86400  # 1 day
+
+    async def _fetch() -> typing.Any:
+        output = await asyncio.to_thread(func)
+        output = await _set(prefix, suffix, output, tags)
+        logger.info("cache", adjective="miss", prefix=prefix, suffix=suffix, key=key)
+        return output
+
     with _telemetry.tracer.start_as_current_span("get-or-return-cached") as span:
         span.set_attribute("key", key)
         span.set_attribute("prefix", prefix)
         span.set_attribute("suffix", suffix)
-
-        output = _get(key)
-
-        if output is not None:
-            span.set_attribute("adjective", "hit")
-            logger.info("cache", adjective="hit", prefix=prefix, suffix=suffix, key=key)
-            return json.loads(output)
-        else:
-            span.set_attribute("adjective", "miss")
-            output = await asyncio.to_thread(func)
-            _set(key, json.dumps(output), ex=expiry)
-            logger.info("cache", adjective="miss", prefix=prefix, suffix=suffix, key=key)
-            return output
+        return await _read_through(span, prefix, suffix, _fetch)
 
 
-def create_or_return_async_task_data(prefix: str, suffix: str) -> AsyncTaskData:
+async def create_or_return_async_task_data(prefix: str, suffix: str) -> AsyncTaskData:
     key = f"{prefix}-{suffix}"
-    expiry = 86400  # 1 day
-
-    raw = _get(key)
+    raw = await _get(key, shared=True)
 
     if raw is None:
         task_data = AsyncTaskData(
             task_id=key, task_status=TaskDataStatus.in_progress, task_data=None
         )
-        _set(key, json.dumps(task_data.to_dict()), ex=expiry)
+        await _set(prefix, suffix, task_data.to_dict())
         return task_data
 
-    return AsyncTaskData.from_dict(json.loads(raw))
+    return AsyncTaskData.from_dict(raw)
 
 
-def get_async_task_data(prefix: str, suffix: str) -> AsyncTaskData:
+async def get_async_task_data(prefix: str, suffix: str) -> AsyncTaskData:
     key = f"{prefix}-{suffix}"
-    raw = _get(key)
+    raw = await _get(key, shared=True)
     if raw is None:
         raise KeyError(key)
-    return AsyncTaskData.from_dict(json.loads(raw))
+    return AsyncTaskData.from_dict(raw)
 
 
-def set_async_task_data(prefix: str, suffix: str, task_data: AsyncTaskData) -> None:
-    key = f"{prefix}-{suffix}"
-    expiry = 86400  # 1 day
-    _set(key, json.dumps(task_data.to_dict()), ex=expiry)
+async def set_async_task_data(prefix: str, suffix: str, task_data: AsyncTaskData) -> None:
+    await _set(prefix, suffix, task_data.to_dict())
+
+
+async def delete_async_task_data(prefix: str, suffix: str) -> None:
+    await _delete(f"{prefix}-{suffix}")
+
+
+async def get_data(prefix: str, suffix: str) -> typing.Any | None:
+    """A value stored with `set_data`, or None. Read-only, like every cached value."""
+    return await _get(f"{prefix}-{suffix}")
+
+
+async def set_data(
+    prefix: str, suffix: str, value: typing.Any, tags: tuple[str, ...] = ()
+) -> typing.Any:
+    """Store `value`, returning the read-only copy that `get_data` will hand out."""
+    return await _set(prefix, suffix, value, tags)
+
+
+async def delete_data(prefix: str, suffix: str) -> None:
+    await _delete(f"{prefix}-{suffix}")
@@ -12,10 +12,9 @@ import sys
 import typing
 
 import dotenv
-import requests  # type: ignore
 import structlog
 
-from backend import bsky, cache, worker
+from backend import bench, bsky, cache, data_science, worker, xrpc
 
 
 def _parse_kwargs(input_str: str) -> dict[str, typing.Any]:
@@ -42,21 +41,24 @@ def _parse_kwargs(input_str: str) -> dict[str, typing.Any]:
 
 
 def cmd_clear_cache(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
-    cache.delete_keys(args.suffix)
+    if args.suffix is not None:
+        deleted = cache.delete_keys(args.suffix)
+    elif args.prefix is not None:
+        deleted = cache.delete_prefix(args.prefix)
+    else:
+        deleted = cache.delete_tag(args.tag)
+    print(f"deleted {len(deleted)} keys")
 
 
 def cmd_bsky_cli(bsky_instance: "bsky.Bsky", args: argparse.Namespace) -> None:
     cache_suffix = f"tasks.bsky-{args.path}-{args.kwargs}".replace(" ", "-")
 
-    def _get_request():
-        response = requests.get(
-            f"https://bsky.social/xrpc/{args.path}",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {bsky_instance.client._session.access_jwt}",
-            },
+    async def _get_request():
+        response = await xrpc.XrpcClient().get(
+            args.path,
+            _parse_kwargs(args.kwargs),
+            bsky_instance.client._session.access_jwt,
             timeout=30,
-            params=_parse_kwargs(args.kwargs),
         )
         response.raise_for_status()
         return response
@@ -83,11 +85,14 @@ def cmd_bsky_get_author_feed_texts(bsky_instance: "bsky.Bsky", args: argparse.Na
 
 
 def cmd_bsky_emoji_summary(bsky_instance: "bsky.Bsky", args: argparse.Namespace) -> None:
-    task_id = f"emoji-summary-{args.handle}"
+    process = (
+        worker.process_emoji_summary_incremental
+        if args.incremental
+        else worker.process_emoji_summary
+    )
     results = asyncio.run(
-        worker.process_emoji_summary(
+        process(
             bsky_instance.client,
-            task_id,
             args.handle,
             args.num_keywords,
             args.num_feed_pages,
@@ -96,6 +101,13 @@ def cmd_bsky_emoji_summary(bsky_instance: "bsky.Bsky", args: argparse.Namespace)
     print(json.dumps(results, indent=2))
 
 
+def cmd_build_emoji_index(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
+    client = data_science.DataScienceClient()
+    asyncio.run(client.initialize())
+    # initialize() only builds when there's no index yet, so rebuild explicitly.
+    print(data_science.build_emoji_index(client))
+
+
 def cmd_stream_video(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
     chunk_size = args.chunk_size * 1024  # Convert KB
     print(f"Streaming video from {args.path} with chunk size {chunk_size}")
@@ -120,12 +132,37 @@ def cmd_stream_video(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
     print("\nDone")
 
 
+def cmd_bench_cache_hits(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
+    print(json.dumps(bench.cache_hits(args.iterations), indent=2))
+
+
+def cmd_bench_graph_memory(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
+    print(json.dumps(bench.graph_memory(args.sources, args.edges), indent=2))
+
+
+def cmd_bench_emoji_matching(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
+    print(json.dumps(bench.emoji_matching(args.keywords), indent=2))
+
+
+def cmd_bench_nlp_startup(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
+    print(json.dumps(bench.nlp_startup(args.model, args.pipelines), indent=2))
+
+
+def cmd_bench_feed_pipeline(_bsky: "bsky.Bsky", args: argparse.Namespace) -> None:
+    print(
+        json.dumps(bench.feed_pipeline(args.pages, args.latency_ms, args.processing_ms), indent=2)
+    )
+
+
 def _build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(prog="backend-cli")
     subs = parser.add_subparsers(dest="cmd", required=True)
 
-    p = subs.add_parser("clear-cache", help="Delete cache keys with the given suffix.")
-    p.add_argument("--suffix", required=True)
+    p = subs.add_parser("clear-cache", help="Delete cache keys by suffix, prefix or tag.")
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument("--suffix")
+    group.add_argument("--prefix")
+    group.add_argument("--tag")
     p.set_defaults(func=cmd_clear_cache)
 
     p = subs.add_parser("bsky-cli", help="Call a Bluesky XRPC endpoint with caching.")
@@ -142,13 +179,41 @@ def _build_parser() -> argparse.ArgumentParser:
     p.add_argument("--handle", required=True)
     p.add_argument("--num-keywords", type=int, default=25)
     p.add_argument("--num-feed-pages", type=int, default=25)
+    p.add_argument("--incremental", action="store_true")
     p.set_defaults(func=cmd_bsky_emoji_summary)
 
+    p = subs.add_parser("build-emoji-index", help="Precompute the emoji embedding index.")
+    p.set_defaults(func=cmd_build_emoji_index)
+
     p = subs.add_parser("stream-video", help="Stream a local video file demo.")
     p.add_argument("--path", required=True)
     p.add_argument("--chunk-size", type=int, default=1)
     p.set_defaults(func=cmd_stream_video)
 
+    p = subs.add_parser("bench-cache-hits", help="Benchmark cache hit latency.")
+    p.add_argument("--iterations", type=int, default=2000)
+    p.set_defaults(func=cmd_bench_cache_hits)
+
+    p = subs.add_parser("bench-graph-memory", help="Benchmark follow graph memory use.")
+    p.add_argument("--sources", type=int, default=50)
+    p.add_argument("--edges", type=int, default=5000)
+    p.set_defaults(func=cmd_bench_graph_memory)
+
+    p = subs.add_parser("bench-emoji-matching", help="Benchmark and check emoji matching.")
+    p.add_argument("--keywords", nargs="*", default=None)
+    p.set_defaults(func=cmd_bench_emoji_matching)
+
+    p = subs.add_parser("bench-nlp-startup", help="Benchmark spaCy load time and memory.")
+    p.add_argument("--model", default=None)
+    p.add_argument("--pipelines", nargs="*", default=None)
+    p.set_defaults(func=cmd_bench_nlp_startup)
+
+    p = subs.add_parser("bench-feed-pipeline", help="Benchmark pipelined author feed reads.")
+    p.add_argument("--pages", type=int, default=25)
+    p.add_argument("--latency-ms", type=float, default=50)
+    p.add_argument("--processing-ms", type=float, default=50)
+    p.set_defaults(func=cmd_bench_feed_pipeline)
+
     return parser
 
 
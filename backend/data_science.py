@@ -1,8 +1,15 @@
 import asyncio
+import bisect
 import dataclasses
+import hashlib
+import heapq
+import itertools
 import json
 import os
+import pathlib
+import re
 import subprocess
+import threading
 import typing
 
 import nltk  # type: ignore
@@ -10,7 +17,7 @@ import nltk.corpus  # type: ignore
 import numpy
 import spacy
 import spacy.language
-import spacy.tokens.doc as spacy_doc
+import spacy.util
 import structlog
 import yake  # type: ignore
 import yaml  # type: ignore
@@ -18,11 +25,43 @@ import yaml  # type: ignore
 logger = structlog.get_logger()
 
 
+EMOJIS_PATH = "emojis.json"
+
+# Where the precomputed emoji embedding index lives, see `build_emoji_index`.
+EMOJI_INDEX_DIR = os.getenv("EMOJI_INDEX_DIR", ".emoji-index")
+
+# spaCy model to load, either an installed package name or a local directory.
+SPACY_MODEL = os.getenv("SPACY_MODEL", "en_core_web_lg")
+
+# How much of the spaCy pipeline to load:
+# "full" loads every component,
+# "trimmed" loads the model without its components (we only use vectors),
+# "vectors" skips the model entirely and loads just its static vector table.
+SPACY_PIPELINE = os.getenv("SPACY_PIPELINE", "trimmed")
+
+# Components of the en_core_web pipelines, none of which Doc.vector needs.
+_UNUSED_SPACY_COMPONENTS = [
+    "tok2vec",
+    "tagger",
+    "parser",
+    "senter",
+    "attribute_ruler",
+    "lemmatizer",
+    "ner",
+]
+
+# How many keyword vectors each NLP process keeps, see `keyword_vectors`.
+KEYWORD_VECTOR_CACHE_SIZE = int(os.getenv("KEYWORD_VECTOR_CACHE_SIZE", "10000"))
+
+# When true, models must already be on disk, nothing is downloaded at runtime.
+# Set in the container image, which bakes the models in at build time.
+NLP_OFFLINE = os.getenv("NLP_OFFLINE", "").lower().strip() == "true"
+
+
 @dataclasses.dataclass
 class EmojiData:
     emoji: str
     description: str
-    nlp: spacy_doc.Doc
 
 
 @dataclasses.dataclass
@@ -45,6 +84,18 @@ class DataScienceClient:
     ignore_list: set[str] = set()  # noqa: RUF012
     nlp: spacy.language.Language
 
+    # Unit-length description vectors, one row per entry in `emojis`.
+    # Rows for descriptions without a vector are left as zeros.
+    emoji_vectors: numpy.ndarray
+    # Lowercased full description -> indexes into `emojis`
+    emoji_description_index: dict[str, list[int]] = {}  # noqa: RUF012
+    # Lowercased description word -> indexes into `emojis`
+    emoji_word_index: dict[str, list[int]] = {}  # noqa: RUF012
+    # Keyword -> unit-length vector, least recently used first, see `keyword_vectors`
+    # (dicts keep insertion order, a hit is moved to the end by re-inserting it)
+    keyword_vector_cache: dict[str, numpy.ndarray] = {}  # noqa: RUF012
+    keyword_vector_lock = threading.Lock()
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
@@ -55,28 +106,27 @@ class DataScienceClient:
             await asyncio.to_thread(self._load_nltk)
             self.nlp = await asyncio.to_thread(self._load_nlp)
             self.emojis = await asyncio.to_thread(self._load_emojis)
+            await asyncio.to_thread(load_or_build_emoji_index, self)
             self.ignore_list = await asyncio.to_thread(self._load_ignore_list)
             self._initialized = True
 
     def _load_nltk(self):
-        nltk.download("stopwords")
+        # Honors NLTK_DATA, which is where the container image puts its copy.
+        try:
+            nltk.data.find("corpora/stopwords")
+        except LookupError:
+            if NLP_OFFLINE:
+                raise
+            nltk.download("stopwords", download_dir=os.getenv("NLTK_DATA"))
 
     def _load_nlp(self):
-        subprocess.run(["spacy", "download", "en_core_web_lg"], check=True)
-        return spacy.load("en_core_web_lg")
+        return load_nlp(SPACY_MODEL, SPACY_PIPELINE)
 
     def _load_emojis(self):
-        with open(os.path.join("emojis.json"), encoding="utf-8") as _file:
+        with open(EMOJIS_PATH, encoding="utf-8") as _file:
             emojis = json.loads(_file.read())
 
-        return [
-            EmojiData(
-                emojis[emoji_index]["emoji"],
-                emojis[emoji_index]["description"],
-                self.nlp(emojis[emoji_index]["description"]),
-            )
-            for emoji_index in range(len(emojis))
-        ]
+        return [EmojiData(emoji["emoji"], emoji["description"]) for emoji in emojis]
 
     def _load_ignore_list(self):
         with open("nlp_ignore.yml", encoding="utf-8") as _file:
@@ -89,6 +139,128 @@ class DataScienceClient:
         )
 
 
+def _spacy_model_path(model: str) -> pathlib.Path:
+    """Data directory of `model`, a local path or an installed package name."""
+    path = pathlib.Path(model)
+    if path.is_dir():
+        return path
+    version = spacy.util.get_package_version(model)
+    if version is None:
+        raise OSError(f"spaCy model {model} is not installed")
+    return spacy.util.get_package_path(model) / f"{model}-{version}"
+
+
+def load_nlp(model: str, pipeline: str) -> spacy.language.Language:
+    """
+    Load a spaCy model from disk, only downloading it when it's missing
+    and NLP_OFFLINE isn't set. See SPACY_PIPELINE for the `pipeline` modes.
+    """
+    try:
+        model_path = _spacy_model_path(model)
+    except OSError:
+        if NLP_OFFLINE:
+            raise
+        subprocess.run(["spacy", "download", model], check=True)
+        model_path = _spacy_model_path(model)
+
+    if pipeline == "full":
+        return spacy.load(model_path)
+
+    if pipeline == "vectors":
+        meta = spacy.util.load_meta(model_path / "meta.json")
+        nlp = spacy.blank(meta["lang"])
+        nlp.vocab.vectors.from_disk(model_path / "vocab", exclude=["strings"])
+        # Keep the model's identity, the emoji index is keyed on it.
+        nlp.meta.update({key: meta[key] for key in ("name", "version")})
+        return nlp
+
+    return spacy.load(model_path, exclude=_UNUSED_SPACY_COMPONENTS)
+
+
+def _emoji_index_paths(client: DataScienceClient) -> tuple[str, str]:
+    """
+    Paths of the vectors (.npy) and the metadata (.json) of the emoji index.
+    Named by a hash of emojis.json and the spaCy model, so editing either one
+    makes the old index unreachable instead of silently stale.
+    """
+    digest = hashlib.sha256()
+    with open(EMOJIS_PATH, "rb") as _file:
+        digest.update(_file.read())
+    meta = client.nlp.meta
+    digest.update(f"{meta['lang']}_{meta['name']}-{meta['version']}".encode())
+    base = os.path.join(EMOJI_INDEX_DIR, f"emoji-index-{digest.hexdigest()[:16]}")
+    return (f"{base}.npy", f"{base}.json")
+
+
+def _index_emoji_words(client: DataScienceClient) -> None:
+    client.emoji_description_index = {}
+    client.emoji_word_index = {}
+    for emoji_index, emoji in enumerate(client.emojis):
+        description = emoji.description.lower()
+        client.emoji_description_index.setdefault(description, []).append(emoji_index)
+        for word in set(description.split()):
+            client.emoji_word_index.setdefault(word, []).append(emoji_index)
+
+
+def build_emoji_index(client: DataScienceClient) -> str:
+    """
+    Embed every emoji description with spaCy,
+    and write the vectors, descriptions, and word indexes to EMOJI_INDEX_DIR.
+    Returns the path of the vectors file.
+    """
+    vectors_path, meta_path = _emoji_index_paths(client)
+    docs = client.nlp.pipe(emoji.description for emoji in client.emojis)
+    vectors = numpy.array([doc.vector for doc in docs], dtype=numpy.float32)
+    client.emoji_vectors = _normalize_rows(vectors)
+    _index_emoji_words(client)
+
+    os.makedirs(EMOJI_INDEX_DIR, exist_ok=True)
+    # Write to temporary names and rename, so a concurrent reader never sees half a file.
+    # Per process names, NLP pool workers may all build the index at once on a cold start.
+    tmp = f"{os.getpid()}.tmp"
+    with open(f"{vectors_path}.{tmp}", "wb") as _file:
+        numpy.save(_file, client.emoji_vectors)
+    with open(f"{meta_path}.{tmp}", "w", encoding="utf-8") as _file:
+        json.dump(
+            {
+                "emojis": [[emoji.emoji, emoji.description] for emoji in client.emojis],
+                "description_index": client.emoji_description_index,
+                "word_index": client.emoji_word_index,
+            },
+            _file,
+        )
+    os.replace(f"{meta_path}.{tmp}", meta_path)
+    os.replace(f"{vectors_path}.{tmp}", vectors_path)
+    logger.info("emoji-index", adjective="build", path=vectors_path)
+    return vectors_path
+
+
+def load_or_build_emoji_index(client: DataScienceClient) -> None:
+    """
+    Memory-map the emoji index written by `build_emoji_index`,
+    skipping the spaCy pass over every description.
+    Falls back to building it when there isn't one for this emojis.json and model.
+    """
+    vectors_path, meta_path = _emoji_index_paths(client)
+    try:
+        with open(meta_path, encoding="utf-8") as _file:
+            meta = json.load(_file)
+        vectors = numpy.load(vectors_path, mmap_mode="r")
+    except (OSError, ValueError):
+        try:
+            build_emoji_index(client)
+        except OSError as exc:
+            # ex. a read-only filesystem, the in-memory index still works
+            logger.error("emoji-index", adjective="write-error", exc=exc)
+        return
+
+    client.emojis = [EmojiData(emoji, description) for emoji, description in meta["emojis"]]
+    client.emoji_vectors = vectors
+    client.emoji_description_index = meta["description_index"]
+    client.emoji_word_index = meta["word_index"]
+    logger.info("emoji-index", adjective="load", path=vectors_path)
+
+
 def _remove_substring_entries(keywords: list[KeywordData]) -> list[KeywordData]:
     """
     Given a list of keywords, remove any keywords that are substrings of other keywords.
@@ -151,6 +323,149 @@ def extract_keywords(
     return keywords
 
 
+_WORD_PATTERN = re.compile(r"[a-z][a-z'-]*[a-z]")
+
+
+def post_terms(client: DataScienceClient, texts: list[str]) -> list[dict[str, int]]:
+    """
+    Per-post term counts, the token statistics behind `keywords_from_terms`.
+    Terms are the words of a post outside the ignore list,
+    and the bigrams of adjacent ones.
+    """
+    terms = []
+    for text in texts:
+        counts: dict[str, int] = {}
+        previous = None
+        for word in _WORD_PATTERN.findall(text.lower()):
+            if word in client.ignore_list or len(word) < 3:
+                previous = None
+                continue
+            counts[word] = counts.get(word, 0) + 1
+            if previous is not None:
+                bigram = f"{previous} {word}"
+                counts[bigram] = counts.get(bigram, 0) + 1
+            previous = word
+        terms.append(counts)
+    return terms
+
+
+def keywords_from_terms(
+    handle: str, term_totals: dict[str, list[int]], num_keywords: int = 50
+) -> list[KeywordData]:
+    """
+    Keywords from `term -> [term frequency, document frequency]` totals over a
+    handle's posts, as kept up to date by the incremental emoji summary.
+    Terms used in the most posts win, unlike YAKE this doesn't need the full
+    text, so the totals can be updated one post at a time.
+    Scores are document frequencies, higher is better (the reverse of YAKE).
+    """
+    top = heapq.nsmallest(
+        num_keywords,
+        (
+            (-document_frequency, -term_frequency, term)
+            for term, (term_frequency, document_frequency) in term_totals.items()
+            # A phrase used once is more likely a coincidence than a topic
+            if document_frequency > 1 or " " not in term
+        ),
+    )
+    keywords = [
+        KeywordData(numpy.float64(-document_frequency), term) for document_frequency, _, term in top
+    ]
+    keywords = _remove_substring_entries(keywords)
+    logger.info(
+        "keywords-from-terms",
+        handle=handle,
+        **{keyword.keyword.replace(" ", "-"): float(keyword.score) for keyword in keywords},
+    )
+    return keywords
+
+
+def _normalize_rows(vectors: numpy.ndarray) -> numpy.ndarray:
+    """Scale each row to unit length, leaving all-zero rows as zeros."""
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    return numpy.divide(vectors, norms, out=numpy.zeros_like(vectors), where=norms > 0)
+
+
+def _exact_emoji_matches(client: DataScienceClient, keyword: str) -> set[int]:
+    """
+    Emojis that match `keyword` outright:
+    a word of the keyword is the whole description,
+    or a word of the description is the whole keyword,
+    or, case included, the two are identical (Doc.similarity returns exactly 1.0 then).
+    """
+    matches = {
+        emoji_index
+        for emoji_index in client.emoji_description_index.get(keyword.lower(), [])
+        if client.emojis[emoji_index].description == keyword
+    }
+    keyword = keyword.lower()
+    matches.update(client.emoji_word_index.get(keyword, []))
+    for word in keyword.split():
+        matches.update(client.emoji_description_index.get(word, []))
+    return matches
+
+
+def keyword_vectors(client: DataScienceClient, keywords: list[str]) -> numpy.ndarray:
+    """
+    Unit-length vectors of `keywords`, one row each.
+    Keywords seen before (by this process, in any job) come from a bounded LRU
+    cache. The rest are embedded in one `nlp.pipe` batch with every pipeline
+    component disabled, as Doc.vector only needs the tokenizer and the vectors.
+    """
+    found: dict[str, numpy.ndarray] = {}
+    cache = client.keyword_vector_cache
+    with client.keyword_vector_lock:
+        for keyword in keywords:
+            if keyword in cache:
+                found[keyword] = cache[keyword] = cache.pop(keyword)
+    missing = [keyword for keyword in dict.fromkeys(keywords) if keyword not in found]
+
+    if missing:
+        docs = client.nlp.pipe(missing, disable=client.nlp.pipe_names)
+        vectors = _normalize_rows(numpy.array([doc.vector for doc in docs], dtype=numpy.float32))
+        with client.keyword_vector_lock:
+            for keyword, vector in zip(missing, vectors, strict=True):
+                found[keyword] = cache[keyword] = vector
+            while len(cache) > KEYWORD_VECTOR_CACHE_SIZE:
+                del cache[next(iter(cache))]
+
+    return numpy.array([found[keyword] for keyword in keywords], dtype=numpy.float32)
+
+
+def _emoji_similarity_matrix(client: DataScienceClient, keywords: list[str]) -> numpy.ndarray:
+    """
+    Keyword x emoji similarity scores, as one matrix product of unit vectors
+    (the same cosine similarity as spaCy's Doc.similarity),
+    with exact word matches set to the max score of 1.0.
+    """
+    scores = keyword_vectors(client, keywords) @ client.emoji_vectors.T
+    for row, keyword in enumerate(keywords):
+        scores[row, list(_exact_emoji_matches(client, keyword))] = 1.0
+    return scores
+
+
+def _top_k(scores: numpy.ndarray, k: int) -> numpy.ndarray:
+    """
+    Indexes of the `k` highest scores along the last axis of a 1 or 2 dimensional
+    array, highest first, ties in index order (as a stable full sort would give).
+    Selects with a partition, so only the `k` selected get sorted.
+    """
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return numpy.zeros((*scores.shape[:-1], 0), dtype=numpy.intp)
+    rows = numpy.atleast_2d(scores)
+    kth = numpy.partition(rows, rows.shape[-1] - k, axis=-1)[:, -k, None]
+    above = rows > kth
+    # Fill the rest of the k with the first of the scores tied with the kth
+    tied = rows == kth
+    needed = k - above.sum(axis=-1, keepdims=True)
+    selected = above | (tied & (numpy.cumsum(tied, axis=-1) <= needed))
+    top = numpy.nonzero(selected)[1].reshape(len(rows), k)
+    order = numpy.argsort(-numpy.take_along_axis(rows, top, axis=-1), axis=-1, kind="stable")
+    top = numpy.take_along_axis(top, order, axis=-1)
+    return top.reshape((*scores.shape[:-1], k))
+
+
 def get_emoji_match_scores(
     client: DataScienceClient,
     handle: str,
@@ -163,49 +478,27 @@ def get_emoji_match_scores(
     Get the "best of the best" matches of emojis to keywords.
     """
 
-    emoji_match_scores: list[KeywordEmojiData] = []
+    if not keywords:
+        return []
 
-    for keyword_data in keywords:
-        _keyword: spacy_doc.Doc = client.nlp(keyword_data.keyword)
-        keyword_scores: list[KeywordEmojiData] = []
-
-        # Check each keyword against each emoji
-        for emoji_index in range(len(client.emojis)):
-            # Check if emoji is in keyword or vice versa
-            if any(
-                word == client.emojis[emoji_index].description.lower()
-                for word in keyword_data.keyword.lower().split()
-            ) or any(
-                word == keyword_data.keyword.lower()
-                for word in client.emojis[emoji_index].description.lower().split()
-            ):
-                # If so, then set to the max similarity score
-                emoji_match_score = 1.0
-            else:
-                # Otherwise, use semantic similarity
-                # https://spacy.io/api/doc#similarity
-                emoji_match_score = _keyword.similarity(client.emojis[emoji_index].nlp)
-
-            keyword_scores.append(
-                KeywordEmojiData(
-                    str(_keyword),
-                    emoji_match_score,
-                    client.emojis[emoji_index].emoji,
-                )
-            )
-
-        # Sort emoji matches by highest similarity.
-        # and append best match to emoji_match_scores.
-        # Where "best" means "the most similar to the keyword".
-        keyword_scores.sort(key=lambda x: -x.score)
-        emoji_match_scores.append(keyword_scores[0])
-
-    # Sort overall results by highest similarity, and clip them
-    # This results in a list of the best matches for each keyword.
-    # This is intentionally the same sort + clip as above, but on the whole list.
+    # Score every keyword against every emoji at once,
+    # and take the best match for each keyword.
+    # Where "best" means "the most similar to the keyword".
+    keyword_texts = [keyword_data.keyword for keyword_data in keywords]
+    scores = _emoji_similarity_matrix(client, keyword_texts)
+    best = scores.argmax(axis=1)
+    best_scores = scores[numpy.arange(len(keyword_texts)), best]
+
+    # Take the keywords with the highest similarity, highest first.
     # This produces a "best of the best" list.
-    emoji_match_scores.sort(key=lambda x: -x.score)
-    emoji_match_scores = emoji_match_scores[:num_matches]
+    emoji_match_scores: list[KeywordEmojiData] = [
+        KeywordEmojiData(
+            keyword_texts[row],
+            float(best_scores[row]),
+            client.emojis[best[row]].emoji,
+        )
+        for row in _top_k(best_scores, num_matches)
+    ]
     logger.info(
         "emoji-match-scores",
         handle=handle,
@@ -217,20 +510,86 @@ def get_emoji_match_scores(
     return emoji_match_scores
 
 
-def join_description_and_emoji_score(
-    text_lines: list[str], emoji_match_scores: list[KeywordEmojiData]
-):
-    emoji_descriptions = []
-
-    for emoji_score in emoji_match_scores:
-        for quote in text_lines:
-            if str(emoji_score.keyword) in quote:
-                emoji_descriptions.append(
-                    [
-                        emoji_score.emoji,
-                        emoji_score.keyword,
-                        quote,
-                    ]
-                )
+def get_emoji_alternatives(
+    client: DataScienceClient, keywords: list[str], num_alternatives: int = 3
+) -> list[list[KeywordEmojiData]]:
+    """
+    The `num_alternatives` best emojis for each of `keywords`, best first,
+    for when the single best match isn't the one wanted.
+    """
+    if not keywords:
+        return []
+    scores = _emoji_similarity_matrix(client, keywords)
+    return [
+        [
+            KeywordEmojiData(keyword, float(scores[row, column]), client.emojis[column].emoji)
+            for column in columns
+        ]
+        for row, (keyword, columns) in enumerate(
+            zip(keywords, _top_k(scores, num_alternatives), strict=True)
+        )
+    ]
+
+
+class QuoteFinder:
+    """
+    Finds the post lines that quote a keyword.
+    The lines are joined into one string once, with a separator no keyword
+    contains, so each lookup is a single `str.find` scan in C over all the
+    text rather than a Python loop over lines. Match offsets map back to
+    lines by bisecting the line start offsets.
+    """
+
+    _SEPARATOR = "\0"
+
+    def __init__(self, text_lines: list[str]):
+        self.text_lines = text_lines
+        self._text = self._SEPARATOR.join(text_lines)
+        self._line_starts = list(
+            itertools.accumulate((len(line) + 1 for line in text_lines[:-1]), initial=0)
+        )
+
+    def quotes(self, keyword: str, limit: int = 1) -> list[str]:
+        """The first `limit` lines containing `keyword`, in order."""
+        if not keyword or self._SEPARATOR in keyword:
+            return []
+        quotes: list[str] = []
+        position = self._text.find(keyword)
+        while position >= 0 and len(quotes) < limit:
+            line_number = bisect.bisect_right(self._line_starts, position) - 1
+            quotes.append(self.text_lines[line_number])
+            # Each line is quoted at most once, so carry on from the next one
+            if line_number + 1 >= len(self._line_starts):
                 break
-    return emoji_descriptions
+            position = self._text.find(keyword, self._line_starts[line_number + 1])
+        return quotes
+
+
+def join_description_and_emoji_score(
+    text_lines: list[str], emoji_match_scores: list[KeywordEmojiData], num_quotes: int = 1
+) -> list[list[str]]:
+    """
+    [emoji, keyword, quote] rows, one per quote (up to `num_quotes`) of each
+    matched keyword in `text_lines`. Keywords nobody wrote are left out.
+    """
+    quote_finder = QuoteFinder(text_lines)
+    return [
+        [emoji_score.emoji, emoji_score.keyword, quote]
+        for emoji_score in emoji_match_scores
+        for quote in quote_finder.quotes(str(emoji_score.keyword), num_quotes)
+    ]
+
+
+def emoji_summary_for_keywords(
+    client: DataScienceClient,
+    handle: str,
+    text_lines: list[str],
+    keywords: list[KeywordData],
+    num_quotes: int = 1,
+) -> list[list[str]]:
+    """
+    The emoji-summary rows, [emoji, keyword, quote], for keywords picked by
+    `extract_keywords` or `keywords_from_terms`.
+    """
+    emoji_match_scores = get_emoji_match_scores(client, handle, keywords)
+    return join_description_and_emoji_score(text_lines, emoji_match_scores, num_quotes)
@@ -0,0 +1,35 @@
+import contextlib
+import os
+import sqlite3
+import typing
+
+
+def connect(path: str, synchronous: str = "FULL") -> sqlite3.Connection:
+    """
+    A SQLite connection in WAL mode, for one store shared by the
+    asyncio.to_thread workers of a process. Callers serialize it with a lock.
+    Autocommit (isolation_level=None), so writes of more than one statement
+    go through `immediate` to stay atomic across processes.
+    """
+    if path != ":memory:" and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+@contextlib.contextmanager
+def immediate(conn: sqlite3.Connection) -> typing.Iterator[sqlite3.Connection]:
+    """
+    Run the block in one BEGIN IMMEDIATE transaction, taking the write lock
+    up front so another process can't interleave. Rolled back on any error.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
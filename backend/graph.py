@@ -0,0 +1,120 @@
+import array
+import base64
+import typing
+
+import numpy
+
+# Handles that show up in follow lists but are never worth counting.
+IGNORED_HANDLES = ("", "handle.invalid", "bsky.app")
+
+
+class GraphStore:
+    """
+    Compact follow graph.
+    Handles are interned to integer ids once, and each account's follows are
+    kept as an `array("I")` of those ids, so aggregating friends-of-friends is
+    a numpy.bincount over the concatenated arrays instead of a Python loop
+    over handle strings.
+    """
+
+    def __init__(self) -> None:
+        self.ids: dict[str, int] = {}
+        self.handles: list[str] = []
+        self._following: dict[int, array.array] = {}
+
+    def intern(self, handle: str) -> int:
+        handle_id = self.ids.get(handle)
+        if handle_id is None:
+            handle_id = len(self.handles)
+            self.ids[handle] = handle_id
+            self.handles.append(handle)
+        return handle_id
+
+    def add_following(self, handle: str, following: typing.Iterable[str]) -> None:
+        intern = self.intern
+        self._following[intern(handle)] = array.array("I", (intern(f) for f in following))
+
+    def has_following(self, handle: str) -> bool:
+        return handle in self.ids and self.ids[handle] in self._following
+
+    def replace_following(
+        self, counts: numpy.ndarray, handle: str, following: typing.Iterable[str]
+    ) -> numpy.ndarray:
+        """
+        Swap in a new follow list for `handle`, and return `counts`
+        (as from `follower_counts`) adjusted by the difference between the old
+        and new lists, without touching anyone else's.
+        """
+        old = self._following.get(self.intern(handle), array.array("I"))
+        self.add_following(handle, following)
+        new = self._following[self.ids[handle]]
+        size = len(self.handles)
+        counts = numpy.pad(counts, (0, size - len(counts)))
+        counts -= numpy.bincount(numpy.frombuffer(old, dtype=numpy.uint32), minlength=size)
+        counts += numpy.bincount(numpy.frombuffer(new, dtype=numpy.uint32), minlength=size)
+        return counts
+
+    def ids_of(self, handles: typing.Iterable[str]) -> numpy.ndarray:
+        """Ids of the `handles` this store knows about, unknown handles are dropped."""
+        return numpy.fromiter(
+            (self.ids[handle] for handle in handles if handle in self.ids), dtype=numpy.uint32
+        )
+
+    def follower_counts(self) -> numpy.ndarray:
+        """
+        For every interned handle, how many of the accounts added through
+        `add_following` follow it. Indexed by id.
+        """
+        if not self._following:
+            return numpy.zeros(len(self.handles), dtype=numpy.int64)
+        edges = numpy.concatenate(
+            [numpy.frombuffer(follows, dtype=numpy.uint32) for follows in self._following.values()]
+        )
+        return numpy.bincount(edges, minlength=len(self.handles))
+
+    def exclude(self, counts: numpy.ndarray, handles: typing.Iterable[str]) -> None:
+        """Zero out the counts of `handles`, in place."""
+        counts[self.ids_of(handles)] = 0
+
+    def counts_to_dict(self, counts: numpy.ndarray) -> dict[str, int]:
+        return {self.handles[i]: int(counts[i]) for i in numpy.flatnonzero(counts)}
+
+    def ranked(self, counts: numpy.ndarray, limit: int | None = None) -> list[tuple[str, int]]:
+        """
+        (handle, count) for every non-zero count, highest count first,
+        ties broken by handle so the order is the same on every call.
+        With `limit`, only the top `limit`, selected before sorting.
+        """
+        candidates = numpy.flatnonzero(counts)
+        if limit is not None and limit < len(candidates):
+            # Keep everyone tied with the last place, so the cut below is by handle
+            cutoff = -numpy.partition(-counts[candidates], limit - 1)[limit - 1]
+            candidates = candidates[counts[candidates] >= cutoff]
+        handles = numpy.array(self.handles, dtype=object)[candidates]
+        order = numpy.lexsort((handles, -counts[candidates]))[:limit]
+        return [(handles[i], int(counts[candidates[i]])) for i in order]
+
+    def to_state(self) -> dict[str, typing.Any]:
+        """JSON friendly form, for the cache. Follow lists stay packed, as base64."""
+        return {
+            "handles": list(self.handles),
+            "following": {
+                self.handles[handle_id]: base64.b64encode(follows.tobytes()).decode()
+                for handle_id, follows in self._following.items()
+            },
+        }
+
+    @classmethod
+    def from_state(cls, state: typing.Mapping[str, typing.Any]) -> "GraphStore":
+        store = cls()
+        for handle in state["handles"]:
+            store.intern(handle)
+        for handle, encoded in state["following"].items():
+            follows = array.array("I")
+            follows.frombytes(base64.b64decode(encoded))
+            store._following[store.ids[handle]] = follows
+        return store
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the adjacency arrays, excluding the interner."""
+        return sum(follows.itemsize * len(follows) for follows in self._following.values())
@@ -0,0 +1,487 @@
+import abc
+import asyncio
+import dataclasses
+import enum
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import typing
+
+import structlog
+
+from . import cache, db, streaming
+
+logger = structlog.get_logger()
+
+# Where the SQLite job backend keeps its database. ":memory:" for a throwaway one.
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.sqlite3")
+
+# Worker coroutines pulling jobs, ie. how many jobs run at once.
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))
+
+# New jobs are refused once this many are waiting, see `JobQueueFullError`.
+JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", "100"))
+
+# A failed job is retried after JOBS_RETRY_BACKOFF * 2^(attempt - 1) seconds,
+# and given up on after JOBS_MAX_ATTEMPTS attempts.
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))
+JOBS_RETRY_BACKOFF = float(os.getenv("JOBS_RETRY_BACKOFF", "5"))
+
+# Running jobs heartbeat this often. One that hasn't for JOBS_STALE_AFTER seconds
+# is assumed lost with its worker (ex. a pod restart) and is queued again.
+JOBS_HEARTBEAT_INTERVAL = float(os.getenv("JOBS_HEARTBEAT_INTERVAL", "10"))
+JOBS_STALE_AFTER = float(os.getenv("JOBS_STALE_AFTER", "60"))
+
+# How long an idle worker waits before checking the backend for due retries.
+JOBS_POLL_INTERVAL = 1.0
+
+# A worker that hits a database error backs off from JOBS_POLL_INTERVAL,
+# doubling up to this, before trying the backend again.
+JOBS_ERROR_BACKOFF_MAX = 30.0
+
+
+class JobStatus(enum.Enum):
+    queued = "queued"
+    running = "running"
+    failed = "failed"
+    completed = "completed"
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Job:
+    """
+    A unit of background work.
+    `kind` and `key` double as the cache prefix and suffix of the job's
+    AsyncTaskData, and `id` as its task_id.
+    """
+
+    id: str
+    kind: str
+    key: str
+    payload: dict[str, typing.Any]
+    status: JobStatus
+    attempts: int = 0
+    run_after: float = 0.0
+    worker: str | None = None
+    heartbeat_at: float | None = None
+    result: typing.Any | None = None
+    error: str | None = None
+    created_at: float = 0.0
+    updated_at: float = 0.0
+
+    @property
+    def task_status(self) -> cache.TaskDataStatus:
+        return {
+            JobStatus.failed: cache.TaskDataStatus.failed,
+            JobStatus.completed: cache.TaskDataStatus.completed,
+        }.get(self.status, cache.TaskDataStatus.in_progress)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "key": self.key,
+            "status": self.status.value,
+            "task_status": self.task_status.value,
+            "attempts": self.attempts,
+            "run_after": self.run_after,
+            "heartbeat_at": self.heartbeat_at,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class JobBackend(abc.ABC):
+    """
+    Persistent job storage. Every method is synchronous,
+    `JobRunner` calls them through asyncio.to_thread.
+    """
+
+    @abc.abstractmethod
+    def enqueue(self, job: Job, max_queued: int) -> Job:
+        """
+        Add `job`, or return the existing one if it's still queued or running.
+        Finished jobs with the same id are reset and queued again.
+        Raises JobQueueFullError when `max_queued` jobs are already waiting.
+        """
+
+    @abc.abstractmethod
+    def claim(self, worker: str, now: float) -> Job | None:
+        """Atomically take the oldest due queued job and mark it running."""
+
+    @abc.abstractmethod
+    def heartbeat(self, job_id: str, worker: str, now: float) -> bool:
+        """False if `worker` no longer owns the job, ie. it was reclaimed."""
+
+    @abc.abstractmethod
+    def complete(self, job_id: str, worker: str, result: typing.Any, now: float) -> None: ...
+
+    @abc.abstractmethod
+    def fail(
+        self, job_id: str, worker: str, error: str, retry_at: float | None, now: float
+    ) -> None:
+        """Queue the job again at `retry_at`, or mark it failed for good if None."""
+
+    @abc.abstractmethod
+    def release(self, job_id: str, worker: str, now: float) -> None:
+        """Hand a running job back to the queue without counting the attempt."""
+
+    @abc.abstractmethod
+    def reclaim_stale(self, stale_before: float, max_attempts: int, now: float) -> list[Job]:
+        """
+        Queue running jobs whose last heartbeat is before `stale_before` again.
+        Ones out of attempts are failed instead, and returned.
+        """
+
+    @abc.abstractmethod
+    def get(self, job_id: str) -> Job | None: ...
+
+
+class SQLiteJobBackend(JobBackend):
+    _schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,
+            worker TEXT,
+            heartbeat_at REAL,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_after);
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH) -> None:
+        self._conn = db.connect(path)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(self._schema)
+
+    def _row_to_job(self, row: sqlite3.Row) -> Job:
+        return Job(
+            id=row["id"],
+            kind=row["kind"],
+            key=row["key"],
+            payload=json.loads(row["payload"]),
+            status=JobStatus(row["status"]),
+            attempts=row["attempts"],
+            run_after=row["run_after"],
+            worker=row["worker"],
+            heartbeat_at=row["heartbeat_at"],
+            result=None if row["result"] is None else json.loads(row["result"]),
+            error=row["error"],
+            created_at=row["created_at"],
+            updated_at=row["updated_at"],
+        )
+
+    def enqueue(self, job: Job, max_queued: int) -> Job:
+        with self._lock, db.immediate(self._conn):
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job.id,)).fetchone()
+            if row is not None and row["status"] in (
+                JobStatus.queued.value,
+                JobStatus.running.value,
+            ):
+                return self._row_to_job(row)
+
+            (queued,) = self._conn.execute(
+                "SELECT count(*) FROM jobs WHERE status = ?", (JobStatus.queued.value,)
+            ).fetchone()
+            if queued >= max_queued:
+                raise JobQueueFullError(f"{queued} jobs already queued")
+
+            self._conn.execute(
+                """
+                INSERT INTO jobs (id, kind, key, payload, status, attempts, run_after,
+                                  created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    payload = excluded.payload, status = excluded.status, attempts = 0,
+                    run_after = excluded.run_after, worker = NULL, heartbeat_at = NULL,
+                    result = NULL, error = NULL, updated_at = excluded.updated_at
+                """,
+                (
+                    job.id,
+                    job.kind,
+                    job.key,
+                    json.dumps(job.payload),
+                    JobStatus.queued.value,
+                    job.run_after,
+                    job.created_at,
+                    job.updated_at,
+                ),
+            )
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job.id,)).fetchone()
+        return self._row_to_job(row)
+
+    def claim(self, worker: str, now: float) -> Job | None:
+        with self._lock:
+            row = self._conn.execute(
+                """
+                UPDATE jobs
+                SET status = ?, worker = ?, heartbeat_at = ?, attempts = attempts + 1,
+                    updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs WHERE status = ? AND run_after <= ?
+                    ORDER BY run_after LIMIT 1
+                )
+                RETURNING *
+                """,
+                (JobStatus.running.value, worker, now, now, JobStatus.queued.value, now),
+            ).fetchone()
+        return None if row is None else self._row_to_job(row)
+
+    def heartbeat(self, job_id: str, worker: str, now: float) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ? AND status = ?",
+                (now, job_id, worker, JobStatus.running.value),
+            )
+        return cursor.rowcount > 0
+
+    def complete(self, job_id: str, worker: str, result: typing.Any, now: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                """
+                UPDATE jobs SET status = ?, result = ?, error = NULL, worker = NULL,
+                                updated_at = ?
+                WHERE id = ? AND worker = ?
+                """,
+                (JobStatus.completed.value, json.dumps(result), now, job_id, worker),
+            )
+
+    def fail(
+        self, job_id: str, worker: str, error: str, retry_at: float | None, now: float
+    ) -> None:
+        status = JobStatus.failed if retry_at is None else JobStatus.queued
+        with self._lock:
+            self._conn.execute(
+                """
+                UPDATE jobs SET status = ?, error = ?, run_after = ?, worker = NULL,
+                                updated_at = ?
+                WHERE id = ? AND worker = ?
+                """,
+                (status.value, error, retry_at or now, now, job_id, worker),
+            )
+
+    def release(self, job_id: str, worker: str, now: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                """
+                UPDATE jobs SET status = ?, attempts = attempts - 1, worker = NULL,
+                                run_after = ?, updated_at = ?
+                WHERE id = ? AND worker = ? AND status = ?
+                """,
+                (JobStatus.queued.value, now, now, job_id, worker, JobStatus.running.value),
+            )
+
+    def reclaim_stale(self, stale_before: float, max_attempts: int, now: float) -> list[Job]:
+        with self._lock:
+            failed = self._conn.execute(
+                """
+                UPDATE jobs SET status = ?, error = ?, worker = NULL, updated_at = ?
+                WHERE status = ? AND heartbeat_at < ? AND attempts >= ?
+                RETURNING *
+                """,
+                (
+                    JobStatus.failed.value,
+                    "worker lost",
+                    now,
+                    JobStatus.running.value,
+                    stale_before,
+                    max_attempts,
+                ),
+            ).fetchall()
+            requeued = self._conn.execute(
+                """
+                UPDATE jobs SET status = ?, worker = NULL, run_after = ?, updated_at = ?
+                WHERE status = ? AND heartbeat_at < ?
+                """,
+                (JobStatus.queued.value, now, now, JobStatus.running.value, stale_before),
+            ).rowcount
+        if failed or requeued:
+            logger.info("jobs", adjective="reclaim", requeued=requeued, failed=len(failed))
+        return [self._row_to_job(row) for row in failed]
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else self._row_to_job(row)
+
+
+JobHandler = typing.Callable[[Job], typing.Awaitable[typing.Any]]
+
+
+class JobRunner:
+    """
+    Runs jobs from a persistent backend on JOBS_WORKERS worker coroutines.
+    Failed jobs are retried with exponential backoff, running jobs heartbeat,
+    and jobs orphaned by a dead process are picked up again after JOBS_STALE_AFTER.
+    Final results and failures are mirrored into the job's AsyncTaskData cache entry.
+    """
+
+    _instance: typing.Optional["JobRunner"] = None
+    _backend: JobBackend | None = None
+    _handlers: dict[str, JobHandler]
+    _tasks: set[asyncio.Task]
+    _wakeup: asyncio.Event | None = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._handlers = {}
+            cls._instance._tasks = set()
+        return cls._instance
+
+    @property
+    def backend(self) -> JobBackend:
+        if self._backend is None:
+            self._backend = SQLiteJobBackend()
+        return self._backend
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self._handlers[kind] = handler
+
+    async def start(self, workers: int = JOBS_WORKERS) -> None:
+        self._wakeup = asyncio.Event()
+        await self._reclaim(stale_before=time.time() - JOBS_STALE_AFTER)
+        worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        for index in range(workers):
+            self._spawn(self._work(f"{worker_prefix}-{index}"))
+        self._spawn(self._reap())
+
+    def _spawn(self, coroutine: typing.Coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def enqueue(self, kind: str, key: str, payload: dict[str, typing.Any]) -> Job:
+        now = time.time()
+        job = Job(
+            id=f"{kind}-{key}",
+            kind=kind,
+            key=key,
+            payload=payload,
+            status=JobStatus.queued,
+            run_after=now,
+            created_at=now,
+            updated_at=now,
+        )
+        job = await asyncio.to_thread(self.backend.enqueue, job, JOBS_MAX_QUEUED)
+        if job.attempts == 0:
+            # Not started yet, so any events under this id are from an earlier run.
+            streaming.ProgressBroker().reset(job.id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Job | None:
+        return await asyncio.to_thread(self.backend.get, job_id)
+
+    async def _reclaim(self, stale_before: float) -> None:
+        lost = await asyncio.to_thread(
+            self.backend.reclaim_stale, stale_before, JOBS_MAX_ATTEMPTS, time.time()
+        )
+        for job in lost:
+            await self._mirror(job, cache.TaskDataStatus.failed, job.error)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(JOBS_HEARTBEAT_INTERVAL)
+            try:
+                await self._reclaim(stale_before=time.time() - JOBS_STALE_AFTER)
+            except sqlite3.Error as exc:
+                logger.error("jobs", adjective="reclaim-error", exc=exc)
+
+    async def _work(self, worker: str) -> None:
+        assert self._wakeup is not None
+        backoff = JOBS_POLL_INTERVAL
+        while True:
+            try:
+                job = await asyncio.to_thread(self.backend.claim, worker, time.time())
+                if job is not None:
+                    await self._run(worker, job)
+            except sqlite3.Error as exc:
+                # ex. the database is locked or its disk is full, don't let the queue stall
+                logger.error("jobs", adjective="worker-error", worker=worker, exc=exc, wait=backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, JOBS_ERROR_BACKOFF_MAX)
+                continue
+            backoff = JOBS_POLL_INTERVAL
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOBS_POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+
+    async def _run(self, worker: str, job: Job) -> None:
+        logger.info("jobs", adjective="start", job=job.id, attempt=job.attempts, worker=worker)
+        broker = streaming.ProgressBroker()
+        broker.reset(job.id)
+        broker.publish(job.id, "started", {"attempt": job.attempts})
+        heartbeat = asyncio.create_task(self._heartbeat(worker, job))
+        try:
+            handler = self._handlers[job.kind]
+            result = await handler(job)
+        except asyncio.CancelledError:
+            # Shutting down, let the next process pick it up right away.
+            await asyncio.to_thread(self.backend.release, job.id, worker, time.time())
+            raise
+        except Exception as exc:
+            retry_at = None
+            if job.attempts < JOBS_MAX_ATTEMPTS:
+                retry_at = time.time() + JOBS_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+            logger.error("jobs", adjective="error", job=job.id, attempt=job.attempts, exc=exc)
+            await asyncio.to_thread(
+                self.backend.fail, job.id, worker, str(exc), retry_at, time.time()
+            )
+            if retry_at is None:
+                await self._mirror(job, cache.TaskDataStatus.failed, str(exc))
+            else:
+                broker.publish(
+                    job.id,
+                    "retrying",
+                    {"attempt": job.attempts, "error": str(exc), "retry_at": retry_at},
+                )
+        else:
+            await asyncio.to_thread(self.backend.complete, job.id, worker, result, time.time())
+            await self._mirror(job, cache.TaskDataStatus.completed, result)
+            logger.info("jobs", adjective="complete", job=job.id, worker=worker)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, worker: str, job: Job) -> None:
+        while True:
+            await asyncio.sleep(JOBS_HEARTBEAT_INTERVAL)
+            if not await asyncio.to_thread(self.backend.heartbeat, job.id, worker, time.time()):
+                logger.warning("jobs", adjective="lost", job=job.id, worker=worker)
+                return
+
+    async def _mirror(self, job: Job, status: cache.TaskDataStatus, data: typing.Any) -> None:
+        """Record a finished job in its cache entry, and tell its stream subscribers."""
+        task_data = cache.AsyncTaskData(task_id=job.id, task_status=status, task_data=data)
+        await cache.set_async_task_data(job.kind, job.key, task_data)
+        streaming.ProgressBroker().publish(job.id, status.value, task_data.to_dict())
@@ -1,4 +1,7 @@
 import asyncio
+import contextlib
+import functools
+import typing
 
 import dotenv
 import fastapi
@@ -6,10 +9,33 @@ import opentelemetry.instrumentation.fastapi as otel_fastapi
 import structlog
 import structlog.processors
 
-from . import application, bsky, cache, streaming, worker
+from . import application, bsky, cache, data_science, jobs, nlp_pool, streaming, worker, xrpc
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    # Load the NLP models while the server starts, not during the first request.
+    nlp_pool.NlpPool().start()
+    runner = jobs.JobRunner()
+    # Handlers get the Bsky singleton, not its client, so startup doesn't log in
+    # and jobs use whatever client is current when they run.
+    runner.register("emoji-summary", functools.partial(worker.emoji_summary_job, bsky_instance))
+    runner.register(
+        "emoji-summary-incremental", functools.partial(worker.emoji_summary_job, bsky_instance)
+    )
+    runner.register("popularity", functools.partial(worker.popularity_job, bsky_instance))
+    runner.register(
+        "popularity-update", functools.partial(worker.popularity_update_job, bsky_instance)
+    )
+    await runner.start()
+    yield
+    await runner.stop()
+    nlp_pool.NlpPool().shutdown()
+    await xrpc.XrpcClient().aclose()
+
 
 dotenv.load_dotenv()
-(app, limiter) = application.init()
+(app, limiter) = application.init(lifespan)
 bsky_instance = bsky.Bsky()
 
 structlog.configure(
@@ -37,8 +63,37 @@ async def cache_clear(request: fastapi.Request, suffix: str):
     """
     Clear the cache for a given suffix.
     """
-    cache.delete_keys(suffix)
-    return {"status": "ok"}
+    deleted = await asyncio.to_thread(cache.delete_keys, suffix)
+    return {"status": "ok", "deleted": len(deleted)}
+
+
+@app.get("/cache/clear-prefix/{prefix}")
+@app.get("/cache/clear-prefix/{prefix}/")
+async def cache_clear_prefix(request: fastapi.Request, prefix: str):
+    """
+    Clear the cache for every key under a prefix (ex. bsky.graph-following).
+    """
+    deleted = await asyncio.to_thread(cache.delete_prefix, prefix)
+    return {"status": "ok", "deleted": len(deleted)}
+
+
+@app.get("/cache/clear-tag/{tag}")
+@app.get("/cache/clear-tag/{tag}/")
+async def cache_clear_tag(request: fastapi.Request, tag: str):
+    """
+    Clear the cache for every key with a tag (ex. graph, feed).
+    """
+    deleted = await asyncio.to_thread(cache.delete_tag, tag)
+    return {"status": "ok", "deleted": len(deleted)}
+
+
+@app.get("/cache/stats")
+@app.get("/cache/stats/")
+async def cache_stats(request: fastapi.Request):
+    """
+    Hit / miss / eviction counters and current size of the cache.
+    """
+    return await asyncio.to_thread(cache.stats)
 
 
 @app.get("/streaming")
@@ -95,43 +150,111 @@ async def bsky_profile(request: fastapi.Request, handle: str):
 async def bsky_mutuals(request: fastapi.Request, handle: str):
     """People I follow who follow me back"""
     handle = bsky.handle_scrubber(handle)
-    followers = await bsky.get_followers(bsky_instance.client, handle)
     following = await bsky.get_following(bsky_instance.client, handle)
-    mutuals = {k: v for k, v in followers.items() if k in following}
+    mutuals = {
+        profile["did"]: profile
+        async for page in bsky.iter_followers_pages(bsky_instance.client, handle)
+        for profile in page
+        if profile["did"] in following
+    }
     return mutuals
 
 
+def _popularity_response(page: tuple[dict[str, int], int, bool], materialized: bool) -> dict:
+    (popularity, next_index, partial) = page
+    return {
+        "popularity": popularity,
+        "next": next_index,
+        "partial": partial,
+        "materialized": materialized,
+    }
+
+
+async def _queue_popularity_build(handle: str) -> None:
+    # When the queue is full, the next request tries again
+    with contextlib.suppress(jobs.JobQueueFullError):
+        await jobs.JobRunner().enqueue("popularity", handle, {})
+
+
 @app.get("/bsky/{handle}/popularity")
 @app.get("/bsky/{handle}/popularity/")
+@limiter.limit("10/minute")
 async def bluesky_popularity(request: fastapi.Request, handle: str):
     """
     For every person I follow,
     list people who they follow,
     and aggregate that list to see how popular each person is.
+    The first page of the materialized view when there is one, continued at
+    /popularity/ranked/{next}. Otherwise a page aggregated live from a slice
+    of follows, continued at /popularity/{next}, while the view is built.
+    "materialized" says which.
     """
     handle = bsky.handle_scrubber(handle)
-    (popularity, next_index) = await bsky.popularity(bsky_instance.client, handle, 0)
-    return {
-        "popularity": popularity,
-        "next": next_index,
-    }
+    page = await bsky.popularity_view_page(handle, 0)
+    if page is not None:
+        return _popularity_response(page, materialized=True)
+    await _queue_popularity_build(handle)
+    page = await bsky.popularity(bsky_instance.client, handle, 0)
+    return _popularity_response(page, materialized=False)
+
+
+@app.get("/bsky/{handle}/popularity/refresh/{source}")
+@app.get("/bsky/{handle}/popularity/refresh/{source}/")
+@limiter.limit("10/second")
+async def bluesky_popularity_refresh(request: fastapi.Request, handle: str, source: str):
+    """
+    Queue an update of the materialized popularity view,
+    for when {source} (someone I follow) has changed who they follow.
+    Returns the job, see /jobs/{job_id}.
+    """
+    handle = bsky.handle_scrubber(handle)
+    source = bsky.handle_scrubber(source)
+    try:
+        job = await jobs.JobRunner().enqueue(
+            "popularity-update", f"{handle}-{source}", {"handle": handle, "source": source}
+        )
+    except jobs.JobQueueFullError as exc:
+        raise fastapi.HTTPException(
+            status_code=503, detail=str(exc), headers={"Retry-After": "30"}
+        ) from exc
+    return job.to_dict()
+
+
+@app.get("/bsky/{handle}/popularity/ranked/{offset}")
+@app.get("/bsky/{handle}/popularity/ranked/{offset}/")
+@limiter.limit("10/second")
+async def bluesky_popularity_ranked_page(
+    request: fastapi.Request, handle: str, offset: typing.Annotated[int, fastapi.Path(ge=0)]
+):
+    """
+    The materialized popularity view from rank {offset}, most popular first.
+    404 (and a build queued) if it hasn't been built.
+    """
+    handle = bsky.handle_scrubber(handle)
+    page = await bsky.popularity_view_page(handle, offset)
+    if page is None:
+        await _queue_popularity_build(handle)
+        raise fastapi.HTTPException(
+            status_code=404, detail=f"popularity of {handle} isn't materialized yet"
+        )
+    return _popularity_response(page, materialized=True)
 
 
 @app.get("/bsky/{handle}/popularity/{index}")
 @app.get("/bsky/{handle}/popularity/{index}/")
+@limiter.limit("10/minute")
 async def bluesky_popularity_page(request: fastapi.Request, handle: str, index: int):
     """
     For every person I follow,
     list people who they follow,
     and aggregate that list to see how popular each person is.
-    This returns the {index} page of the popularity list.
+    This returns the {index} page of the popularity list, always aggregated
+    live from a slice of follows, so paging isn't switched over to the
+    materialized view midway.
     """
     handle = bsky.handle_scrubber(handle)
-    (popularity, next_index) = await bsky.popularity(bsky_instance.client, handle, index)
-    return {
-        "popularity": popularity,
-        "next": next_index,
-    }
+    page = await bsky.popularity(bsky_instance.client, handle, index)
+    return _popularity_response(page, materialized=False)
 
 
 @app.get("/bsky/{handle}/suggestions")
@@ -141,30 +264,38 @@ async def bsky_suggestions(request: fastapi.Request, handle: str):
     """
     For every person I follow,
     list people who they follow,
+    ranked by how many of my follows follow them,
     returning the first page of a list.
     """
     handle = bsky.handle_scrubber(handle)
-    (suggestions, next_index) = await bsky.suggestions(bsky_instance.client, handle, 0)
+    (suggestions, next_cursor, partial) = await bsky.suggestions(bsky_instance.client, handle)
     return {
         "suggestions": suggestions,
-        "next": next_index,
+        "next": next_cursor,
+        "partial": partial,
     }
 
 
-@app.get("/bsky/{handle}/suggestions/{index}")
-@app.get("/bsky/{handle}/suggestions/{index}/")
+@app.get("/bsky/{handle}/suggestions/{cursor}")
+@app.get("/bsky/{handle}/suggestions/{cursor}/")
 @limiter.limit("10/second")
-async def bsky_suggestions_page(request: fastapi.Request, handle: str, index: int):
+async def bsky_suggestions_page(request: fastapi.Request, handle: str, cursor: str):
     """
     For every person I follow,
     list people who they follow,
-    returning the {index} page of a list.
+    returning the page after {cursor} (the `next` of the previous page).
     """
     handle = bsky.handle_scrubber(handle)
-    (suggestions, next_index) = await bsky.suggestions(bsky_instance.client, handle, index)
+    try:
+        (suggestions, next_cursor, partial) = await bsky.suggestions(
+            bsky_instance.client, handle, cursor
+        )
+    except ValueError as exc:
+        raise fastapi.HTTPException(status_code=400, detail=str(exc)) from exc
     return {
         "suggestions": suggestions,
-        "next": next_index,
+        "next": next_cursor,
+        "partial": partial,
     }
 
 
@@ -202,33 +333,147 @@ async def bsky_author_feed_text(request: fastapi.Request, handle: str):
     }
 
 
+async def _start_emoji_summary(
+    handle: str, num_keywords: int, num_feed_pages: int, incremental: bool
+) -> cache.AsyncTaskData:
+    # Incremental runs are their own task and job, so a cached full summary
+    # doesn't stand in for a refresh, and neither run swallows the other.
+    kind = "emoji-summary-incremental" if incremental else "emoji-summary"
+
+    # Store initial status in cache
+    async_task_data = await cache.create_or_return_async_task_data(kind, handle)
+
+    # If there's no result yet, make sure a job is queued for it.
+    # Enqueueing is a no-op while that job is still queued or running.
+    if async_task_data.task_data is None:
+        try:
+            await jobs.JobRunner().enqueue(
+                kind,
+                handle,
+                {"num_keywords": num_keywords, "num_feed_pages": num_feed_pages},
+            )
+        except jobs.JobQueueFullError as exc:
+            await cache.delete_async_task_data(kind, handle)
+            raise fastapi.HTTPException(
+                status_code=503, detail=str(exc), headers={"Retry-After": "30"}
+            ) from exc
+
+    return async_task_data
+
+
 @app.get("/bsky/{handle}/emoji-summary")
 @app.get("/bsky/{handle}/emoji-summary/")
 @limiter.limit("10/second")
 async def bsky_emoji_summary_start(
-    request: fastapi.Request, handle: str, num_keywords: int = 25, num_feed_pages: int = 25
+    request: fastapi.Request,
+    handle: str,
+    num_keywords: int = 25,
+    num_feed_pages: int = 25,
+    incremental: bool = False,
 ):
     """
     Start generating an emoji summary for a user's posts.
     Returns a task ID that can be used to check the status.
+    With `incremental`, only posts newer than the last incremental run are processed.
     """
     handle = bsky.handle_scrubber(handle)
+    async_task_data = await _start_emoji_summary(handle, num_keywords, num_feed_pages, incremental)
+    return async_task_data.to_dict()
 
-    # Store initial status in cache
-    async_task_data = cache.create_or_return_async_task_data(
-        "emoji-summary",
-        handle,
+
+async def _finished_job_event(job_id: str) -> tuple[str, typing.Any] | None:
+    """
+    The terminal stream event of a job, read from the job backend,
+    for jobs finished outside this process's ProgressBroker.
+    """
+    job = await jobs.JobRunner().get(job_id)
+    if job is None or job.status not in (jobs.JobStatus.completed, jobs.JobStatus.failed):
+        return None
+    task_data = cache.AsyncTaskData(
+        task_id=job.id,
+        task_status=job.task_status,
+        task_data=job.result if job.status == jobs.JobStatus.completed else job.error,
     )
+    return (job.task_status.value, task_data.to_dict())
 
-    # If the task ID is not found, start the task in the background
-    if async_task_data.task_data is None:
-        asyncio.create_task(  # noqa: RUF006
-            worker.process_emoji_summary(
-                bsky_instance.client, async_task_data.task_id, handle, num_keywords, num_feed_pages
-            )
+
+@app.get("/bsky/{handle}/emoji-summary/stream")
+@app.get("/bsky/{handle}/emoji-summary/stream/")
+@limiter.limit("10/second")
+async def bsky_emoji_summary_stream(
+    request: fastapi.Request,
+    handle: str,
+    num_keywords: int = 25,
+    num_feed_pages: int = 25,
+    incremental: bool = False,
+):
+    """
+    Start an emoji summary like `bsky_emoji_summary_start`, and stream its
+    progress as server-sent events instead of being polled: "started",
+    "page" per feed page fetched, "keywords", "retrying", then the summary
+    rows as "match" events once matching is done, and "completed" or
+    "failed" carrying the same task data polling returns.
+    Ends with "timeout" instead after STREAM_MAX_DURATION.
+    """
+    handle = bsky.handle_scrubber(handle)
+    async_task_data = await _start_emoji_summary(handle, num_keywords, num_feed_pages, incremental)
+
+    if async_task_data.task_data is not None:
+        # Already finished, there's nothing to follow
+        events: typing.AsyncIterable[str] = streaming.single_event(
+            async_task_data.task_status.value, async_task_data.to_dict()
+        )
+    else:
+        events = streaming.ProgressBroker().subscribe(
+            async_task_data.task_id,
+            functools.partial(_finished_job_event, async_task_data.task_id),
         )
 
-    return async_task_data.to_dict()
+    return fastapi.responses.StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/emoji/alternatives")
+@app.get("/emoji/alternatives/")
+@limiter.limit("10/second")
+async def emoji_alternatives(
+    request: fastapi.Request,
+    keyword: typing.Annotated[list[str], fastapi.Query(min_length=1, max_length=50)],
+    num_alternatives: typing.Annotated[int, fastapi.Query(ge=1, le=20)] = 3,
+):
+    """
+    The best few emojis for each ?keyword=, best first,
+    as alternatives to the single match an emoji summary picks.
+    """
+    alternatives = await nlp_pool.NlpPool().run(
+        data_science.get_emoji_alternatives, keyword, num_alternatives
+    )
+    return {
+        "alternatives": [
+            {
+                "keyword": keyword_text,
+                "emojis": [{"emoji": match.emoji, "score": match.score} for match in matches],
+            }
+            for keyword_text, matches in zip(keyword, alternatives, strict=True)
+        ]
+    }
+
+
+@app.get("/jobs/{job_id}")
+@app.get("/jobs/{job_id}/")
+@limiter.limit("10/second")
+async def job_status(request: fastapi.Request, job_id: str):
+    """
+    Status, attempts, and result or error of a background job,
+    by the task_id returned when it was started.
+    """
+    job = await jobs.JobRunner().get(job_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404, detail=f"job {job_id} not found")
+    return job.to_dict()
 
 
 # TODO: integrations with external services I already have credentials for in sibling repos.
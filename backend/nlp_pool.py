@@ -0,0 +1,94 @@
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import os
+import typing
+
+import structlog
+
+from . import data_science
+
+logger = structlog.get_logger()
+
+# Processes running the NLP stages of the emoji-summary job. Each one loads its
+# own spaCy model, so memory grows with the count. 0 runs them in a thread of
+# this process instead, which still blocks on the GIL but skips the extra models.
+NLP_WORKERS = int(os.getenv("NLP_WORKERS", "1"))
+
+# Set in each worker process by `_init_worker`.
+_worker_client: data_science.DataScienceClient | None = None
+
+
+def _init_worker() -> None:
+    global _worker_client
+    _worker_client = data_science.DataScienceClient()
+    asyncio.run(_worker_client.initialize())
+    logger.info("nlp-pool", adjective="worker-ready", pid=os.getpid())
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _call_with_client[T](func: typing.Callable[..., T], *args: typing.Any) -> T:
+    assert _worker_client is not None
+    return func(_worker_client, *args)
+
+
+class NlpPool:
+    """
+    Process pool for the CPU bound NLP work (YAKE, spaCy, numpy),
+    so it runs beside the event loop instead of on it.
+    Every worker initializes a DataScienceClient once, when it starts,
+    and keeps it for all the jobs it runs.
+    """
+
+    _instance: typing.Optional["NlpPool"] = None
+    _executor: concurrent.futures.ProcessPoolExecutor | None = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    @property
+    def executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=NLP_WORKERS,
+                # Not fork, the parent has threads (the cache sweeper, the event loop's).
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return self._executor
+
+    def start(self) -> None:
+        """Spawn and initialize the workers now, rather than on the first job."""
+        if NLP_WORKERS > 0:
+            for _ in range(NLP_WORKERS):
+                self.executor.submit(_ping)
+
+    async def run[T](self, func: typing.Callable[..., T], *args: typing.Any) -> T:
+        """
+        Call `func(client, *args)` in a worker, where `client` is that worker's
+        DataScienceClient. `func` and `args` have to be picklable, so module level.
+        """
+        if NLP_WORKERS <= 0:
+            client = data_science.DataScienceClient()
+            await client.initialize()
+            return await asyncio.to_thread(func, client, *args)
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, _call_with_client, func, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (ex. OOM killed), start over with a fresh pool next time.
+            logger.error("nlp-pool", adjective="broken")
+            self.shutdown()
+            raise
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
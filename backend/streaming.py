@@ -1,4 +1,6 @@
 import asyncio
+import json
+import os
 import typing
 
 
@@ -6,3 +8,105 @@ async def testing() -> typing.AsyncGenerator[str]:
     for i in range(100):
         await asyncio.sleep(1)
         yield f"Hello, world! {i}\n"
+
+
+# Events that end a topic's stream.
+TERMINAL_EVENTS = ("completed", "failed")
+
+# How long a finished topic's events are kept for late subscribers, in seconds.
+PROGRESS_RETENTION = 60.0
+
+# Comment line sent to idle streams, so proxies don't time them out.
+# Idle streams also check their `poll` this often, see `ProgressBroker.subscribe`.
+KEEPALIVE_INTERVAL = 15.0
+
+# Streams are closed with a "timeout" event after this many seconds, whatever
+# happened to their job, so none is held open forever.
+STREAM_MAX_DURATION = float(os.getenv("STREAM_MAX_DURATION", "900"))
+
+# Returns the terminal (event, data) of a topic from wherever it is recorded,
+# or None while it is still going.
+Poll = typing.Callable[[], typing.Awaitable[tuple[str, typing.Any] | None]]
+
+
+def sse(event: str, data: typing.Any) -> str:
+    """Format one server-sent event, https://html.spec.whatwg.org/#server-sent-events"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def single_event(event: str, data: typing.Any) -> typing.AsyncGenerator[str]:
+    yield sse(event, data)
+
+
+class ProgressBroker:
+    """
+    In-process pub/sub of job progress events, one topic per job id.
+    Every topic keeps its events so far, so subscribing late replays them
+    before following along live, until a terminal event.
+    """
+
+    _instance: typing.Optional["ProgressBroker"] = None
+    _history: dict[str, list[tuple[str, typing.Any]]]
+    _subscribers: dict[str, set[asyncio.Queue]]
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._history = {}
+            cls._instance._subscribers = {}
+        return cls._instance
+
+    def publish(self, topic: str, event: str, data: typing.Any = None) -> None:
+        self._history.setdefault(topic, []).append((event, data))
+        for queue in self._subscribers.get(topic, ()):
+            queue.put_nowait((event, data))
+        if event in TERMINAL_EVENTS:
+            asyncio.get_running_loop().call_later(PROGRESS_RETENTION, self._expire, topic)
+
+    def reset(self, topic: str) -> None:
+        """Forget a topic's events, ex. when its job starts over."""
+        self._history.pop(topic, None)
+
+    def _expire(self, topic: str) -> None:
+        # Unless the topic started over since
+        history = self._history.get(topic)
+        if history and history[-1][0] in TERMINAL_EVENTS:
+            del self._history[topic]
+
+    async def subscribe(self, topic: str, poll: Poll | None = None) -> typing.AsyncGenerator[str]:
+        """
+        SSE formatted events of `topic`, past and future, ending after a terminal one.
+        Events only reach this process's broker, so a job run by another process
+        (or reclaimed after a restart) never publishes here. While idle, `poll` is
+        asked for the terminal event instead, and after STREAM_MAX_DURATION the
+        stream ends with a "timeout" event regardless.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in self._history.get(topic, ()):
+            queue.put_nowait(item)
+        self._subscribers.setdefault(topic, set()).add(queue)
+        deadline = asyncio.get_running_loop().time() + STREAM_MAX_DURATION
+        try:
+            while True:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    yield sse("timeout", {"after": STREAM_MAX_DURATION})
+                    return
+                try:
+                    event, data = await asyncio.wait_for(
+                        queue.get(), min(KEEPALIVE_INTERVAL, remaining)
+                    )
+                except TimeoutError:
+                    terminal = await poll() if poll is not None else None
+                    if terminal is not None:
+                        yield sse(*terminal)
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse(event, data)
+                if event in TERMINAL_EVENTS:
+                    return
+        finally:
+            self._subscribers[topic].discard(queue)
+            if not self._subscribers[topic]:
+                del self._subscribers[topic]
@@ -1,58 +1,201 @@
+import asyncio
+import contextlib
+import functools
+import typing
+
 import atproto  # type: ignore
+import structlog
+
+from . import bsky, cache, data_science, jobs, nlp_pool, streaming
+
+logger = structlog.get_logger()
+
+
+# Called with (event, data) as the job makes progress, see `streaming.ProgressBroker`.
+Progress = typing.Callable[[str, typing.Any], None]
 
-from . import bsky, cache, data_science
+
+def _no_progress(event: str, data: typing.Any) -> None:
+    pass
+
+
+def _publish_matches(progress: Progress, emoji_descriptions: list[list[str]]) -> None:
+    for emoji, keyword, quote in emoji_descriptions:
+        progress("match", {"emoji": emoji, "keyword": keyword, "quote": quote})
 
 
 async def process_emoji_summary(
-    bsky_client: atproto.Client, task_id: str, handle: str, num_keywords: int, num_feed_pages: int
-) -> list[tuple[str, str, str]]:
+    bsky_client: atproto.Client,
+    handle: str,
+    num_keywords: int,
+    num_feed_pages: int,
+    progress: Progress = _no_progress,
+) -> list[list[str]]:
+    """
+    Compute the emoji summary of a handle's posts.
+    Raises on failure, retries and recording the outcome are up to the caller.
+    """
+    # Get the author's feed texts
+    text_lines = await bsky.get_author_feed_texts(
+        bsky_client,
+        handle,
+        num_feed_pages,
+        on_page=lambda page, posts: progress("page", {"page": page, "posts": posts}),
+    )
+
+    # Get the keywords and emoji match scores,
+    # in the NLP worker processes so the event loop stays responsive
+    keywords = await nlp_pool.NlpPool().run(
+        data_science.extract_keywords, handle, "\n".join(text_lines), num_keywords
+    )
+    progress("keywords", {"keywords": [keyword.keyword for keyword in keywords]})
+    emoji_descriptions = await nlp_pool.NlpPool().run(
+        data_science.emoji_summary_for_keywords, handle, text_lines, keywords
+    )
+    _publish_matches(progress, emoji_descriptions)
+    return emoji_descriptions
+
+
+async def emoji_summary_job(bsky_instance: bsky.Bsky, job: jobs.Job) -> list[list[str]]:
+    """
+    `jobs.JobRunner` handler for "emoji-summary" and "emoji-summary-incremental"
+    jobs, keyed by handle. Progress is published under the job id.
+    """
+    process = (
+        process_emoji_summary_incremental
+        if job.kind == "emoji-summary-incremental"
+        else process_emoji_summary
+    )
+    return await process(
+        bsky_instance.client,
+        job.key,
+        job.payload["num_keywords"],
+        job.payload["num_feed_pages"],
+        functools.partial(streaming.ProgressBroker().publish, job.id),
+    )
+
+
+async def popularity_job(bsky_instance: bsky.Bsky, job: jobs.Job) -> dict[str, typing.Any]:
+    """`jobs.JobRunner` handler for "popularity" jobs, keyed by handle."""
+    return await bsky.build_popularity_view(bsky_instance.client, job.key)
+
+
+async def popularity_update_job(bsky_instance: bsky.Bsky, job: jobs.Job) -> dict[str, typing.Any]:
     """
-    Process the emoji summary in the background.
-    Updates cache with progress and results.
+    `jobs.JobRunner` handler for "popularity-update" jobs, keyed by
+    "{handle}-{source}", with both in the payload.
     """
+    return await bsky.update_popularity_view(
+        bsky_instance.client, job.payload["handle"], job.payload["source"]
+    )
+
+
+# Cache prefix of the per-handle state behind incremental emoji summaries.
+EMOJI_SUMMARY_STATE_PREFIX = "emoji-summary-state"
+
+# Posts per author feed page, see `bsky.get_author_feed_posts`.
+_FEED_PAGE_SIZE = 100
+
+
+def _add_term_counts(
+    totals: dict[str, list[int]], terms: typing.Mapping[str, int], sign: int
+) -> None:
+    """Add (sign=1) or remove (sign=-1) one post's term counts to the totals, in place."""
+    for term, count in terms.items():
+        total = totals.setdefault(term, [0, 0])
+        total[0] += sign * count
+        total[1] += sign
+        if total[1] <= 0:
+            del totals[term]
+
+
+async def process_emoji_summary_incremental(
+    bsky_client: atproto.Client,
+    handle: str,
+    num_keywords: int,
+    num_feed_pages: int,
+    progress: Progress = _no_progress,
+) -> list[list[str]]:
+    """
+    `process_emoji_summary`, reusing the posts processed by the previous run.
+    Per handle it keeps the newest post URI, the recent posts with their term
+    counts, and term totals across them. A refresh only fetches and tokenizes
+    posts newer than last time, and updates the totals with those plus the
+    posts that fell out of the window, instead of starting over.
+    Keywords come from `data_science.keywords_from_terms` rather than YAKE.
+    """
+    state = await cache.get_data(EMOJI_SUMMARY_STATE_PREFIX, handle)
+    since_uri = state["newest_uri"] if state else None
+
+    # Walk the feed back to the newest post seen last time. Each page is
+    # tokenized in the NLP pool while the next one downloads.
+    new_posts: list[dict[str, str]] = []
+    term_batches: list[asyncio.Future] = []
+    reached = False
     try:
-        # Initialize the data science client,
-        # run the true initialization in the background because it's slow
-        data_science_client = data_science.DataScienceClient()
-        await data_science_client.initialize()
-
-        # Get the author's feed texts
-        text_lines = await bsky.get_author_feed_texts(bsky_client, handle, num_feed_pages)
-        text_joined = "\n".join(text_lines)
-
-        # Get the keywords and emoji match scores
-        keywords = data_science.extract_keywords(
-            data_science_client, handle, text_joined, num_keywords
-        )
-        emoji_match_scores = data_science.get_emoji_match_scores(
-            data_science_client, handle, keywords
-        )
-        emoji_descriptions = data_science.join_description_and_emoji_score(
-            text_lines, emoji_match_scores
-        )
-
-        # Store results in cache
-        cache.set_async_task_data(
-            "emoji-summary",
-            handle,
-            cache.AsyncTaskData(
-                task_id=task_id,
-                task_status=cache.TaskDataStatus.completed,
-                task_data=emoji_descriptions,
-            ),
-        )
-
-        return emoji_descriptions
-
-    except Exception as exc:
-        cache.set_async_task_data(
-            "emoji-summary",
-            handle,
-            cache.AsyncTaskData(
-                task_id=task_id,
-                task_status=cache.TaskDataStatus.failed,
-                task_data=str(exc),
-            ),
-        )
-
-    return []
+        async with contextlib.aclosing(
+            bsky.iter_author_feed_posts(bsky_client, handle, num_feed_pages, fresh=True)
+        ) as pages:
+            page = 0
+            async for page_posts in pages:
+                uris = [post["uri"] for post in page_posts]
+                if since_uri in uris:
+                    page_posts = page_posts[: uris.index(since_uri)]
+                    reached = True
+                progress("page", {"page": page, "posts": len(page_posts)})
+                new_posts += page_posts
+                term_batches.append(
+                    asyncio.ensure_future(
+                        nlp_pool.NlpPool().run(
+                            data_science.post_terms, [post["text"] for post in page_posts]
+                        )
+                    )
+                )
+                if reached:
+                    break
+                page += 1
+        new_terms = [terms for batch in await asyncio.gather(*term_batches) for terms in batch]
+    finally:
+        for batch in term_batches:
+            batch.cancel()
+
+    # Copies, cached values are read-only.
+    # If the previous newest post wasn't reached, there may be a gap, so start over.
+    posts: list[list[typing.Any]] = []
+    totals: dict[str, list[int]] = {}
+    if state and reached:
+        posts = list(state["posts"])
+        totals = {term: list(total) for term, total in state["totals"].items()}
+
+    for terms in new_terms:
+        _add_term_counts(totals, terms, 1)
+    posts = [
+        [post["uri"], post["text"], terms] for post, terms in zip(new_posts, new_terms, strict=True)
+    ] + posts
+
+    # Same history as a full run, num_feed_pages of posts
+    max_posts = num_feed_pages * _FEED_PAGE_SIZE
+    for _, _, terms in posts[max_posts:]:
+        _add_term_counts(totals, terms, -1)
+    posts = posts[:max_posts]
+
+    logger.info(
+        "emoji-summary",
+        adjective="incremental",
+        handle=handle,
+        new_posts=len(new_posts),
+        reused_posts=len(posts) - len(new_posts),
+    )
+    await cache.set_data(
+        EMOJI_SUMMARY_STATE_PREFIX,
+        handle,
+        {"newest_uri": posts[0][0] if posts else None, "posts": posts, "totals": totals},
+    )
+
+    keywords = data_science.keywords_from_terms(handle, totals, num_keywords)
+    progress("keywords", {"keywords": [keyword.keyword for keyword in keywords]})
+    emoji_descriptions = await nlp_pool.NlpPool().run(
+        data_science.emoji_summary_for_keywords, handle, [post[1] for post in posts], keywords
+    )
+    _publish_matches(progress, emoji_descriptions)
+    return emoji_descriptions
@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+import os
+import time
+import typing
+
+import httpx
+import structlog
+
+logger = structlog.get_logger()
+
+XRPC_BASE = os.getenv("BSKY_XRPC_BASE", "https://bsky.social/xrpc")
+XRPC_TIMEOUT = 10
+
+# Pool sizing, see https://www.python-httpx.org/advanced/resource-limits/
+XRPC_MAX_CONNECTIONS = int(os.getenv("XRPC_MAX_CONNECTIONS", "20"))
+XRPC_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("XRPC_MAX_KEEPALIVE_CONNECTIONS", "10"))
+XRPC_KEEPALIVE_EXPIRY = float(os.getenv("XRPC_KEEPALIVE_EXPIRY", "30"))
+XRPC_HTTP2 = os.getenv("XRPC_HTTP2", "true").lower().strip() == "true"
+
+# Upper bound on in-flight requests to any single host, so a fan-out endpoint
+# queues behind the cap instead of opening every connection the pool allows.
+XRPC_PER_HOST_CONCURRENCY = int(os.getenv("XRPC_PER_HOST_CONCURRENCY", "16"))
+
+# When rate limited (429), wait for the window to reset and retry, as long as
+# the wait is short enough to be worth holding the request open for.
+XRPC_RATE_LIMIT_RETRIES = 2
+XRPC_RATE_LIMIT_MAX_WAIT = 5.0
+
+
+def _rate_limit_wait(response: httpx.Response) -> float | None:
+    """
+    Seconds to wait before retrying a rate limited response, or None if it wasn't.
+    Bluesky sends `ratelimit-reset` as a unix timestamp, others send `Retry-After`.
+    """
+    if response.status_code != 429:
+        return None
+    if "retry-after" in response.headers:
+        with contextlib.suppress(ValueError):
+            return max(float(response.headers["retry-after"]), 0.0)
+    if "ratelimit-reset" in response.headers:
+        with contextlib.suppress(ValueError):
+            return max(float(response.headers["ratelimit-reset"]) - time.time(), 0.0)
+    return XRPC_RATE_LIMIT_MAX_WAIT
+
+
+class XrpcClient:
+    """
+    Process-wide async HTTP client for Bluesky XRPC calls.
+    Connections are pooled and kept alive (over HTTP/2 where the server
+    supports it), so repeated calls skip the TCP + TLS handshake.
+    """
+
+    _instance: typing.Optional["XrpcClient"] = None
+    _http: httpx.AsyncClient | None = None
+    _loop: asyncio.AbstractEventLoop | None = None
+    _host_semaphores: dict[str, asyncio.Semaphore]
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._host_semaphores = {}
+        return cls._instance
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        # Pooled connections belong to the event loop that opened them. The
+        # server only ever has one loop, but each CLI `asyncio.run` is a new one.
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._loop is not loop:
+            self._http = httpx.AsyncClient(
+                http2=XRPC_HTTP2,
+                timeout=XRPC_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=XRPC_MAX_CONNECTIONS,
+                    max_keepalive_connections=XRPC_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=XRPC_KEEPALIVE_EXPIRY,
+                ),
+                headers={"Accept": "application/json"},
+            )
+            self._loop = loop
+            self._host_semaphores = {}
+        return self._http
+
+    def _host_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(XRPC_PER_HOST_CONCURRENCY)
+        return self._host_semaphores[host]
+
+    async def get(
+        self,
+        endpoint: str,
+        params: dict[str, typing.Any],
+        access_jwt: str,
+        timeout: float = XRPC_TIMEOUT,
+    ) -> httpx.Response:
+        """GET `{XRPC_BASE}/{endpoint}` with bearer auth. Does not raise on HTTP errors."""
+        http = self.http
+        url = httpx.URL(f"{XRPC_BASE}/{endpoint}")
+        response = await self._get_once(http, url, params, access_jwt, timeout)
+        for _ in range(XRPC_RATE_LIMIT_RETRIES):
+            wait = _rate_limit_wait(response)
+            if wait is None or wait > XRPC_RATE_LIMIT_MAX_WAIT:
+                break
+            logger.info("xrpc", adjective="rate-limited", endpoint=endpoint, wait=wait)
+            await asyncio.sleep(wait)
+            response = await self._get_once(http, url, params, access_jwt, timeout)
+        return response
+
+    async def _get_once(
+        self,
+        http: httpx.AsyncClient,
+        url: httpx.URL,
+        params: dict[str, typing.Any],
+        access_jwt: str,
+        timeout: float,
+    ) -> httpx.Response:
+        async with self._host_semaphore(url.host):
+            return await http.get(
+                url,
+                params=params,
+                headers={"Authorization": f"Bearer {access_jwt}"},
+                timeout=timeout,
+            )
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+            self._loop = None